@@ -0,0 +1,69 @@
+import os
+import sys
+
+# the vitamin_c modules import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'vitamin_c'))
+
+import json
+import pytest
+
+PARAMS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'vitamin_c', 'params_files')
+NDATA = 64
+N_CHANNELS = 2
+X_DIM = 3
+
+
+def make_cvae(**overrides):
+    """untrained CVAE on 64 samples of 2 detectors inferring mass_1, mass_2 and ra, overrides replace params"""
+    tf = pytest.importorskip('tensorflow')
+    pytest.importorskip('tensorflow_probability')
+    from vitamin_c_model import CVAE
+    with open(os.path.join(PARAMS_DIR, 'params.json'), 'r') as fp:
+        params = json.load(fp)
+    with open(os.path.join(PARAMS_DIR, 'bounds.json'), 'r') as fp:
+        bounds = json.load(fp)
+    params['ndata'] = NDATA
+    params['inf_pars'] = ['mass_1','mass_2','ra']
+    params.update(overrides)
+    # mass_1, mass_2 are gaussian in the r2 output and ra is von Mises
+    masks = {"nonperiodic_idx_mask": [0,1], "periodic_idx_mask": [2], "idx_periodic_mask": [0,1,2],
+             "nonperiodic_mask": [True,True,False], "periodic_mask": [False,False,True],
+             "m1_idx_mask": [0], "m2_idx_mask": [1]}
+    tf.random.set_seed(0)
+    return CVAE(X_DIM, NDATA, N_CHANNELS, 4, 2, params, bounds, masks)
+
+
+@pytest.fixture(scope='module')
+def small_cvae():
+    """one untrained CVAE per test module, see make_cvae"""
+    return make_cvae()
+
+RAND_PARS = ['mass_1','mass_2']
+NUM_DETS = 2
+NUM_SAMPLES = 8
+# the third file is short, so index // tset_split would map the later samples to the wrong file
+TRAINING_ROWS = [100, 100, 30, 100]
+
+
+def write_training_file(path, start, num_rows):
+    """training file whose samples all hold their own global index"""
+    np = pytest.importorskip('numpy')
+    h5py = pytest.importorskip('h5py')
+    index = np.arange(start, start + num_rows, dtype=np.float64)
+    with h5py.File(path, 'w') as hf:
+        hf.create_dataset('x_data', data=index[:,None]*np.ones(len(RAND_PARS)))
+        hf.create_dataset('y_data_noisefree', data=index[:,None,None]*np.ones((NUM_DETS,NUM_SAMPLES)))
+        hf.create_dataset('snrs', data=np.ones((num_rows,NUM_DETS)))
+        hf.create_dataset('rand_pars', data=np.array([k.encode('utf-8') for k in RAND_PARS]))
+
+
+@pytest.fixture
+def training_dir(tmp_path):
+    """directory of training files of TRAINING_ROWS samples each"""
+    input_dir = tmp_path / 'train'
+    input_dir.mkdir()
+    start = 0
+    for i, num_rows in enumerate(TRAINING_ROWS):
+        write_training_file(str(input_dir / 'data_{}-{}.h5py'.format(i + 1, len(TRAINING_ROWS))), start, num_rows)
+        start += num_rows
+    return input_dir
@@ -0,0 +1,86 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+tf = pytest.importorskip('tensorflow')
+
+from conftest import NDATA, N_CHANNELS, X_DIM
+
+
+@pytest.fixture
+def y():
+    return np.random.RandomState(0).normal(size=(3,NDATA,N_CHANNELS)).astype(np.float32)
+
+
+@pytest.mark.parametrize('nsamples', [1, 7, 250])
+def test_gen_samples_count(small_cvae, y, nsamples):
+    samples = small_cvae.gen_samples(y, nsamples=nsamples)
+    assert samples.shape == (nsamples*len(y), X_DIM)
+    assert np.all(np.isfinite(samples))
+
+
+def test_gen_samples_reuses_embedding(small_cvae, y):
+    event = small_cvae.embed_event(y)
+    assert event['features'].shape[0] == len(y)
+    samples = small_cvae.gen_samples(None, nsamples=20, event=event)
+    assert samples.shape == (20*len(y), X_DIM)
+
+
+@pytest.mark.parametrize('nsamples,max_rows', [(250,200), (33,10), (5,50000)])
+def test_gen_samples_batch_count(small_cvae, y, nsamples, max_rows):
+    samples = small_cvae.gen_samples_batch(y, nsamples=nsamples, max_rows=max_rows)
+    assert samples.shape == (len(y), nsamples, X_DIM)
+    assert np.all(np.isfinite(samples))
+
+
+@pytest.mark.parametrize('nsamples,max_samples', [(250,100), (7,1000), (64,64)])
+def test_gen_samples_block_count(small_cvae, y, nsamples, max_samples):
+    samples = small_cvae.gen_samples(y, nsamples=nsamples, max_samples=max_samples)
+    assert samples.shape == (nsamples*len(y), X_DIM)
+    assert np.all(np.isfinite(samples))
+
+
+def test_iter_samples_block_sizes(small_cvae, y):
+    blocks = list(small_cvae.iter_samples(y, nsamples=250, block_size=100))
+    assert [len(block) for block in blocks] == [100, 100, 50]
+    assert all(block.shape[1:] == (len(y), X_DIM) for block in blocks)
+
+
+def test_gen_samples_into_preallocated_array(small_cvae, y):
+    out = np.full((40*len(y), X_DIM), np.nan, dtype=np.float32)
+    assert small_cvae.gen_samples(y, nsamples=40, max_samples=16, out=out) is out
+    assert np.all(np.isfinite(out))
+
+
+def test_in_bounds_sampling_is_exact(small_cvae, y):
+    samples = small_cvae.gen_samples(y, nsamples=101, max_samples=32, in_bounds=True)
+    assert samples.shape == (101*len(y), X_DIM)
+    assert np.all(small_cvae.in_bounds_mask(samples))
+
+    batch = small_cvae.gen_samples_batch(y, nsamples=101, max_rows=64, in_bounds=True)
+    assert batch.shape == (len(y), 101, X_DIM)
+    assert np.all(small_cvae.in_bounds_mask(batch))
+
+
+def test_prior_mask_orders_denormalised_masses():
+    from vitamin_c_model import in_prior_mask
+    bounds = {'mass_1_min': 10.0, 'mass_1_max': 20.0, 'mass_2_min': 5.0, 'mass_2_max': 40.0}
+    # equal normalised masses are m1 = 15 < m2 = 22.5, the second row is m1 = 20 >= m2 = 12
+    x = np.array([[0.5,0.5,0.1], [1.0,0.2,0.1], [1.2,0.2,0.1]])
+    np.testing.assert_array_equal(in_prior_mask(x, ['mass_1','mass_2','ra'], bounds), [False, True, False])
+    np.testing.assert_array_equal(in_prior_mask(x[:,1:], ['mass_2','ra'], bounds), [True, True, True])
+
+
+@pytest.mark.parametrize('latent_sampling', ['iid', 'sobol'])
+@pytest.mark.parametrize('antithetic', [False, True])
+def test_latent_sampling_modes(small_cvae, y, latent_sampling, antithetic):
+    event = small_cvae.embed_event(y)
+    z = small_cvae.sample_latent(event, 33, latent_sampling=latent_sampling, antithetic=antithetic).numpy()
+    assert z.shape == (33, len(y), small_cvae.z_dim)
+    assert np.all(np.isfinite(z))
+
+
+@pytest.mark.parametrize('latent_sampling', ['iid', 'sobol'])
+def test_latent_uniforms_stay_inside_unit_interval(small_cvae, latent_sampling):
+    u = small_cvae.latent_uniforms(4096, 8, latent_sampling).numpy()
+    assert u.shape == (4096, 8, small_cvae.z_dim + 1)
+    assert np.all(u > 0.0) and np.all(u < 1.0)
@@ -0,0 +1,43 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+h5py = pytest.importorskip('h5py')
+pytest.importorskip('tensorflow')
+pytest.importorskip('lal')
+
+from load_data import load_all_samples, load_samples
+
+BILBY_PARS = ['mass_1','mass_2']
+
+
+@pytest.fixture
+def params(tmp_path):
+    params = {'pe_dir': str(tmp_path / 'pe'), 'samplers': ['vitamin','dynesty','ptemcee'], 'bilby_results_label': 'test',
+              'bilby_pars': BILBY_PARS, 'n_samples': 50, 'r': 4, 'ref_geocent_time': 0.0}
+    for sampler in params['samplers'][1:]:
+        sampler_dir = tmp_path / ('pe_' + sampler + '1')
+        sampler_dir.mkdir()
+        for i in range(5):
+            # every sample of test case i holds i
+            with h5py.File(str(sampler_dir / 'test_{}.h5py'.format(i)), 'w') as hf:
+                for q in BILBY_PARS:
+                    hf.create_dataset(q + '_post', data=np.full(200, float(i)))
+    return params
+
+
+def test_rows_follow_test_cases(params):
+    samples = load_all_samples(params)
+    assert samples.shape == (2, params['r'], params['n_samples'], len(BILBY_PARS))
+    np.testing.assert_array_equal(samples[:,:,0,0], [[0,1,2,3],[0,1,2,3]])
+    np.testing.assert_array_equal(load_samples(params, 'ptemcee'), samples[1])
+
+
+def test_missing_posterior_raises(params, tmp_path):
+    # test case 2 is only missing for one sampler, the later test cases cannot move up to fill its row
+    (tmp_path / 'pe_ptemcee1' / 'test_2.h5py').unlink()
+    with pytest.raises(ValueError, match=r'\[2\]'):
+        load_all_samples(params)
+    with pytest.raises(ValueError):
+        load_samples(params, 'dynesty')
+    params['r'] = 2
+    assert load_all_samples(params).shape[1] == 2
@@ -0,0 +1,77 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+tf = pytest.importorskip('tensorflow')
+tfp = pytest.importorskip('tensorflow_probability')
+tfd = tfp.distributions
+
+from conftest import NDATA, N_CHANNELS, X_DIM
+from log_density import compare_with_tfp
+
+
+def data(batch=8, seed=0):
+    rng = np.random.RandomState(seed)
+    x = tf.constant(rng.uniform(size=(batch,X_DIM)), dtype=tf.float32)
+    y = tf.constant(rng.normal(size=(batch,NDATA,N_CHANNELS)), dtype=tf.float32)
+    return x, y
+
+
+def tfp_loss(model, x, y):
+    """the loss as computed with TFP distributions before the fused densities, with the q sample at its mean"""
+    masks = model.masks
+    features = model.embed(y)
+    mean_r1, logvar_r1, logweight_r1 = model.encode_r1(features=features)
+    gm_r1 = tfd.MixtureSameFamily(mixture_distribution=tfd.Categorical(logits=logweight_r1),
+                                  components_distribution=tfd.MultivariateNormalDiag(
+                                      loc=mean_r1,
+                                      scale_diag=model.EPS + tf.sqrt(tf.exp(logvar_r1))))
+    mean_q, logvar_q = model.encode_q(x=x, features=features)
+    mvn_q = tfd.MultivariateNormalDiag(loc=mean_q, scale_diag=model.EPS + tf.sqrt(tf.exp(logvar_q)))
+    mean_r2, logvar_r2, _ = model.decode_r2(z=mean_q, features=features)
+    scale_r2 = model.EPS + tf.sqrt(tf.exp(logvar_r2))
+
+    tmvn_r2 = tfd.MultivariateNormalDiag(
+        loc=tf.boolean_mask(tf.squeeze(mean_r2),masks["nonperiodic_mask"],axis=1),
+        scale_diag=tf.boolean_mask(tf.squeeze(scale_r2),masks["nonperiodic_mask"],axis=1))
+    tmvn_r2_cost_recon = -1.0*tf.reduce_mean(tmvn_r2.log_prob(tf.boolean_mask(x,masks["nonperiodic_mask"],axis=1)))
+    vm_r2 = tfd.VonMises(
+        loc=2.0*np.pi*tf.boolean_mask(tf.squeeze(mean_r2),masks["periodic_mask"],axis=1),
+        concentration=tf.math.reciprocal(tf.math.square(tf.boolean_mask(tf.squeeze(2.0*np.pi*scale_r2),masks["periodic_mask"],axis=1))))
+    vm_r2_cost_recon = -1.0*tf.reduce_mean(tf.reduce_sum(tf.math.log(2.0*np.pi) + vm_r2.log_prob(2.0*np.pi*tf.boolean_mask(x,masks["periodic_mask"],axis=1)),axis=1),axis=0)
+
+    cost_KL = -1.0*tf.reduce_mean(mvn_q.entropy()) - tf.reduce_mean(gm_r1.log_prob(mean_q))
+    return tmvn_r2_cost_recon + vm_r2_cost_recon, cost_KL
+
+
+def test_fused_densities_match_tfp():
+    for key, diff in compare_with_tfp().items():
+        assert diff < 1e-3, key
+
+
+def test_compute_loss_matches_tfp_loss(small_cvae, monkeypatch):
+    x, y = data()
+    # put the q sample at its mean so both losses see the same latent draw
+    monkeypatch.setattr(tf.random, 'normal', lambda shape, *args, **kwargs: tf.zeros(shape))
+    r_loss, kl_loss = small_cvae.compute_loss(x, y)
+    r_ref, kl_ref = tfp_loss(small_cvae, x, y)
+    assert r_loss.shape == kl_loss.shape == ()
+    np.testing.assert_allclose(r_loss.numpy(), r_ref.numpy(), rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(kl_loss.numpy(), kl_ref.numpy(), rtol=1e-4, atol=1e-4)
+
+
+def test_recon_loss_only_scores_matching_events(small_cvae, monkeypatch):
+    x, y = data()
+    monkeypatch.setattr(tf.random, 'normal', lambda shape, *args, **kwargs: tf.zeros(shape))
+    r_batch, _ = small_cvae.compute_loss(x, y)
+    # the batch loss is the mean of the single event losses
+    r_single = [small_cvae.compute_loss(x[i:i + 1], y[i:i + 1])[0].numpy() for i in range(len(x))]
+    np.testing.assert_allclose(r_batch.numpy(), np.mean(r_single), rtol=1e-4, atol=1e-4)
+
+
+def test_train_step_updates_weights(small_cvae):
+    x, y = data(seed=1)
+    optimizer = tf.keras.optimizers.Adam(1e-4)
+    before = [v.numpy().copy() for v in small_cvae.trainable_variables]
+    r_loss, kl_loss = small_cvae.train_step(x, y, optimizer)
+    assert np.isfinite(r_loss.numpy()) and np.isfinite(kl_loss.numpy())
+    assert any(np.any(b != v.numpy()) for b, v in zip(before, small_cvae.trainable_variables))
@@ -0,0 +1,59 @@
+import types
+import pytest
+
+np = pytest.importorskip('numpy')
+h5py = pytest.importorskip('h5py')
+pytest.importorskip('natsort')
+pytest.importorskip('tensorflow')
+pytest.importorskip('lal')
+
+from conftest import RAND_PARS, TRAINING_ROWS, write_training_file
+from load_data import DataLoader, DataManifest
+
+
+def read_global_indices(loader, indices):
+    filenames, file_rows = DataLoader.get_chunk_files(loader, indices)
+    values = []
+    for filename, rows in zip(filenames, file_rows):
+        with h5py.File(str(loader.input_dir / filename), 'r') as hf:
+            values.append(hf['x_data'][:][rows,0])
+    return np.concatenate(values)
+
+
+def test_manifest_maps_indices_across_short_files(training_dir):
+    manifest = DataManifest.build(str(training_dir), num_workers=2)
+    assert manifest.num_data == sum(TRAINING_ROWS)
+    assert list(manifest.rows) == TRAINING_ROWS
+
+    loader = types.SimpleNamespace(input_dir=training_dir, manifest=manifest, filenames=manifest.filenames, params={"tset_split": 100})
+    indices = np.unique(np.concatenate([np.arange(0, sum(TRAINING_ROWS), 7), [199, 200, 229, 230, sum(TRAINING_ROWS) - 1]]))
+    np.testing.assert_array_equal(read_global_indices(loader, indices), indices)
+
+
+def test_manifest_rebuilds_after_file_rewritten_in_place(training_dir):
+    DataManifest.build(str(training_dir), num_workers=2)
+    assert DataManifest.load_or_build(str(training_dir), verify_files=-1).num_data == sum(TRAINING_ROWS)
+
+    # truncating an existing file leaves the directory mtime unchanged
+    write_training_file(str(training_dir / 'data_2-4.h5py'), 100, 40)
+    manifest = DataManifest.load_or_build(str(training_dir), num_workers=2, verify_files=-1)
+    assert list(manifest.rows) == [100, 40, 30, 100]
+    assert manifest.num_data == 270
+
+
+def test_manifest_verifies_a_sample_of_files(training_dir):
+    manifest = DataManifest.build(str(training_dir), num_workers=2)
+    write_training_file(str(training_dir / 'data_2-4.h5py'), 100, 40)
+    assert manifest.verify() == ['data_2-4.h5py']
+    # a sample of every file is the full check, a sample of none checks nothing
+    assert manifest.verify(len(TRAINING_ROWS)) == ['data_2-4.h5py']
+    assert manifest.verify(0) == []
+    assert len(manifest.verify(1)) <= 1
+
+
+def test_manifest_skips_inconsistent_files(training_dir):
+    with h5py.File(str(training_dir / 'data_5-4.h5py'), 'w') as hf:
+        hf.create_dataset('x_data', data=np.zeros((10,len(RAND_PARS) + 1)))
+    manifest = DataManifest.build(str(training_dir), num_workers=2)
+    assert manifest.num_data == sum(TRAINING_ROWS)
+    assert manifest.manifest["skipped"] == ['data_5-4.h5py']
@@ -0,0 +1,43 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+tf = pytest.importorskip('tensorflow')
+
+from multirate import multirate, multirate_length
+
+BANDS = [[512,8],[256,4],[128,2],[128,1]]
+
+
+def test_length_without_bands():
+    assert multirate_length([], 1024) == 1024
+
+
+def test_length_with_bands():
+    assert multirate_length(BANDS, 1024) == 64 + 64 + 64 + 128
+
+
+def test_length_rejects_bands_not_covering_ndata():
+    with pytest.raises(ValueError):
+        multirate_length(BANDS, 2048)
+
+
+def test_length_rejects_band_not_divisible_by_decimation():
+    with pytest.raises(ValueError):
+        multirate_length([[510,4],[514,1]], 1024)
+
+
+def test_numpy_and_tensorflow_agree():
+    y = np.random.RandomState(0).normal(size=(4,1024,3)).astype(np.float32)
+    out = multirate(y, BANDS)
+    assert isinstance(out, np.ndarray)
+    assert out.shape == (4, multirate_length(BANDS, 1024), 3)
+    np.testing.assert_allclose(multirate(tf.constant(y), BANDS).numpy(), out, rtol=1e-5, atol=1e-5)
+
+
+def test_whitened_noise_keeps_unit_variance():
+    y = np.random.RandomState(1).normal(size=(64,1024,2))
+    out = multirate(y, BANDS)
+    start = 0
+    for n, d in BANDS:
+        assert np.std(out[:,start:start + n//d]) == pytest.approx(1.0, abs=0.05)
+        start += n//d
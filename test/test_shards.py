@@ -0,0 +1,60 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('h5py')
+pytest.importorskip('natsort')
+pytest.importorskip('tensorflow')
+pytest.importorskip('lal')
+
+from conftest import NUM_DETS, NUM_SAMPLES, RAND_PARS, TRAINING_ROWS
+from load_data import RawChunkCache, ShardReader, convert_to_shards, is_memory_mapped
+
+LAYOUTS = {'channels_first': {}, 'channels_last': {'channels_last': True}, 'freq_domain': {'freq_domain': True}}
+# files of 100, 100 | 30, 100 samples, so reads cross both file and shard boundaries
+INDICES = np.array([329, 0, 99, 100, 199, 200, 229, 230, 5, 150, 151, 152])
+
+
+def read_waveform_index(data, layout):
+    """the global index held by every read waveform"""
+    if layout == 'freq_domain':
+        assert data['y_data_fft'].shape[1:] == (NUM_DETS, NUM_SAMPLES//2 + 1)
+        return np.fft.irfft(data['y_data_fft'], n=NUM_SAMPLES, axis=2)[:,1]
+    # the reader always returns channels last waveforms
+    assert data['y_data_noisefree'].shape[1:] == (NUM_SAMPLES, NUM_DETS)
+    return data['y_data_noisefree'][:,:,1]
+
+
+@pytest.mark.parametrize('layout', list(LAYOUTS))
+def test_shards_map_indices_across_files_and_shards(training_dir, tmp_path, layout):
+    shard_dir = str(tmp_path / layout)
+    num_data = convert_to_shards(str(training_dir), shard_dir, samples_per_shard=150, silent=True, **LAYOUTS[layout])
+    reader = ShardReader(shard_dir)
+    assert num_data == reader.num_data == sum(TRAINING_ROWS)
+    assert len(reader.filenames) == 2
+    assert [k.decode('utf-8') for k in reader.rand_pars] == RAND_PARS
+
+    expected = np.unique(INDICES)
+    data = reader.read_indices(INDICES)
+    np.testing.assert_array_equal(data['x_data'][:,0], expected)
+    np.testing.assert_allclose(read_waveform_index(data, layout), expected[:,None]*np.ones(NUM_SAMPLES), rtol=1e-6)
+
+
+def test_shard_range_read_stops_at_end(training_dir, tmp_path):
+    shard_dir = str(tmp_path / 'shards')
+    convert_to_shards(str(training_dir), shard_dir, samples_per_shard=150, silent=True)
+    data = ShardReader(shard_dir).read(300, 400)
+    np.testing.assert_array_equal(data['x_data'][:,0], np.arange(300, sum(TRAINING_ROWS)))
+
+
+def test_channels_last_reads_are_memory_mapped(training_dir, tmp_path):
+    shard_dir = str(tmp_path / 'shards')
+    convert_to_shards(str(training_dir), shard_dir, samples_per_shard=150, channels_last=True, silent=True)
+    reader = ShardReader(shard_dir)
+    # a contiguous run in one shard is a view of the memmap and does not count towards the raw cache budget
+    view = reader.read(10, 150)
+    assert is_memory_mapped(view['y_data_noisefree'])
+    assert RawChunkCache.data_nbytes(view) == view['x_data'].nbytes + view['snrs'].nbytes + view['rand_pars'].nbytes
+    # scattered indices are concatenated into a copy which does
+    copy = reader.read_indices(np.array([0, 5, 250]))
+    assert not is_memory_mapped(copy['y_data_noisefree'])
+    assert RawChunkCache.data_nbytes(copy) > copy['x_data'].nbytes + copy['snrs'].nbytes + copy['rand_pars'].nbytes
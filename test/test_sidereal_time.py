@@ -0,0 +1,30 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('lal')
+pytest.importorskip('tensorflow')
+from load_data import greenwich_sidereal_time, convert_ra_to_hour_angle, convert_hour_angle_to_ra
+
+
+@pytest.mark.parametrize('gps_time', [1126259642.5, 1187008882.4, 1e9])
+def test_gmst_matches_astropy(gps_time):
+    time = pytest.importorskip('astropy.time')
+    coordinates = pytest.importorskip('astropy.coordinates')
+    greenwich = coordinates.EarthLocation.of_site('greenwich')
+    expected = time.Time(gps_time, format='gps', location=greenwich).sidereal_time('mean', 'greenwich').radian
+    gmst = greenwich_sidereal_time(gps_time)
+    assert 0.0 <= gmst < 2.0*np.pi
+    assert abs(np.remainder(gmst - expected + np.pi, 2.0*np.pi) - np.pi) < 1e-4
+
+
+def test_hour_angle_round_trip():
+    params = dict(ref_geocent_time=1126259642.5)
+    pars = ['mass_1', 'ra', 'dec']
+    ra = np.linspace(0.0, 2.0*np.pi, 7, endpoint=False)
+    data = np.stack([np.ones_like(ra), ra, np.zeros_like(ra)], axis=1)
+    hour_angle = convert_ra_to_hour_angle(data.copy(), params, pars)
+    # hour angles stay within one turn of the ra prior once the sidereal time is wrapped
+    assert np.all(np.abs(hour_angle[:,1]) < 2.0*np.pi)
+    back = convert_hour_angle_to_ra(hour_angle.copy(), params, pars)
+    np.testing.assert_allclose(back[:,1], ra, atol=1e-10)
+    np.testing.assert_array_equal(back[:,[0,2]], data[:,[0,2]])
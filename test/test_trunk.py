@@ -0,0 +1,54 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+tf = pytest.importorskip('tensorflow')
+
+import vitamin_c_model
+from conftest import NDATA, N_CHANNELS, make_cvae
+
+N_PROJECT = 16
+TRUNK = dict(conv_trunk='params', n_filters_r1=[8,8], filter_size_r1=[5,3], conv_strides_r1=[1,2],
+             conv_dilations_r1=[1,1], maxpool_r1=[1,2], pool_strides_r1=[1,2],
+             parallel_conv=True, parallel_conv_weights='grouped', parallel_conv_features=N_PROJECT)
+
+
+def grouped_trunk(trunk_pooling, towers):
+    if towers:
+        # build the per detector towers used where grouped convolutions are not supported
+        vitamin_c_model.grouped_conv_supported.cache_clear()
+        original = vitamin_c_model.grouped_conv_supported
+        vitamin_c_model.grouped_conv_supported = lambda: False
+        try:
+            return make_cvae(trunk_pooling=trunk_pooling, **TRUNK)
+        finally:
+            vitamin_c_model.grouped_conv_supported = original
+    if not vitamin_c_model.grouped_conv_supported():
+        pytest.skip('grouped convolutions are not supported by this tensorflow')
+    return make_cvae(trunk_pooling=trunk_pooling, **TRUNK)
+
+
+def n_weights(model):
+    return int(sum(np.prod(v.shape) for v in model.trunk.trainable_variables))
+
+
+@pytest.mark.parametrize('towers', [False, True])
+@pytest.mark.parametrize('trunk_pooling,n_features', [('flatten', N_PROJECT), ('global_average', 8)])
+def test_grouped_trunk_keeps_detectors_separate(towers, trunk_pooling, n_features):
+    model = grouped_trunk(trunk_pooling, towers)
+    y = np.random.RandomState(0).normal(size=(4,NDATA,N_CHANNELS)).astype(np.float32)
+    features = model.embed(y).numpy()
+    assert features.shape == (4, N_CHANNELS*n_features)
+
+    # changing the second detector leaves the features of the first, which come first, unchanged
+    y[...,1] += 1.0
+    changed = model.embed(y).numpy()
+    np.testing.assert_allclose(changed[:,:n_features], features[:,:n_features], rtol=1e-5, atol=1e-6)
+    assert np.any(np.abs(changed[:,n_features:] - features[:,n_features:]) > 1e-6)
+
+
+@pytest.mark.parametrize('trunk_pooling', ['flatten', 'global_average'])
+def test_detector_towers_match_grouped_weights(trunk_pooling):
+    grouped = grouped_trunk(trunk_pooling, towers=False)
+    towers = grouped_trunk(trunk_pooling, towers=True)
+    assert n_weights(towers) == n_weights(grouped)
+    assert towers.trunk.output_shape == grouped.trunk.output_shape
@@ -0,0 +1,24 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('tensorflow_probability')
+
+from log_density import check_von_mises_sampler, sample_von_mises
+
+
+@pytest.mark.parametrize('kappa', [0.1, 1.0, 10.0, 100.0, 1e4, 1e5])
+def test_sampler_matches_tfp_cdf(kappa):
+    # the KS distance of 20000 exact draws is below 0.015 with > 99.9% probability
+    ks = check_von_mises_sampler(concentrations=(kappa,), n=20000)[kappa]
+    assert ks['fast'] < 0.015
+    assert ks['tfp'] < 0.015
+
+
+def test_sampler_range_about_location():
+    loc = tf.fill([1000], 3.0)
+    samples = sample_von_mises(loc, tf.fill([1000], 1e4)).numpy()
+    assert np.all(samples >= -np.pi) and np.all(samples < np.pi)
+    # samples close to loc = 3 wrap past pi but stay near it on the circle
+    assert np.all(np.cos(samples - 3.0) > 0.9)
+
@@ -85,7 +85,8 @@ def gen_template(duration,
                  pars,
                  ref_geocent_time, psd_files=[],
                  use_real_det_noise=False,
-                 real_noise_seg =[None,None]
+                 real_noise_seg =[None,None],
+                 return_polarisations=False
                  ):
     """ Generates a whitened waveforms in Gaussian noise.
 
@@ -106,6 +107,8 @@ def gen_template(duration,
     real_noise_seg: list
         list containing the starting and ending times of the real noise 
         segment
+    return_polarisations: bool
+        if True, also return the frequency domain plus and cross polarisations before detector projection
 
     Returns
     -------
@@ -117,6 +120,8 @@ def gen_template(duration,
         interferometer properties
     waveform_generator: bilby function
         function used by bilby to inject signal into noise 
+    polarisations: array_like
+        frequency domain plus and cross polarisations (2, Nt//2 + 1), only if return_polarisations
     """
 
     if sampling_frequency>4096:
@@ -208,8 +213,32 @@ def gen_template(duration,
         whitened_signal_td_all.append([whitened_signal_td])
 
     print('... Whitened signals')
+    if return_polarisations:
+        polarisations = np.array([freq_signal['plus'],freq_signal['cross']])
+        return np.squeeze(np.array(whitened_signal_td_all),axis=1),np.squeeze(np.array(whitened_h_td_all),axis=1),injection_parameters,ifos,waveform_generator,polarisations
     return np.squeeze(np.array(whitened_signal_td_all),axis=1),np.squeeze(np.array(whitened_h_td_all),axis=1),injection_parameters,ifos,waveform_generator
 
+def detector_info(ifos):
+    """ Detector geometry and whitening needed to project stored polarisations onto the detectors.
+
+    Parameters
+    ----------
+    ifos: bilby InterferometerList
+        interferometers the training data was generated with
+
+    Returns
+    -------
+    dict
+        detector_tensors (n_det, 3, 3), detector_vertices (n_det, 3) in metres and
+        whitening_filter (n_det, Nt//2 + 1), the frequency mask divided by the amplitude spectral density
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        whitening_filter = np.array([ifo.strain_data.frequency_mask/ifo.amplitude_spectral_density_array for ifo in ifos])
+    whitening_filter[~np.isfinite(whitening_filter)] = 0.0
+    return dict(detector_tensors=np.array([ifo.detector_tensor for ifo in ifos]),
+                detector_vertices=np.array([ifo.vertex for ifo in ifos]),
+                whitening_filter=whitening_filter)
+
 def run(sampling_frequency=256.0,
            duration=1.,
            N_gen=1000,
@@ -231,6 +260,7 @@ def run(sampling_frequency=256.0,
            use_real_det_noise=False,
            use_real_events=False,
            samp_idx=False,
+           store_polarisations=False,
            ):
     """ Main function to generate both training sample time series 
     and test sample time series/posteriors.
@@ -273,6 +303,9 @@ def run(sampling_frequency=256.0,
         detectors to use
     psd_files
         optional list of psd files to use for each detector
+    store_polarisations: bool
+        if True, training also returns the frequency domain plus and cross polarisations of each sample
+        and the detector information needed to project them again with new extrinsic parameters
     """
 
     # Set up a random seed for result reproducibility.  This is optional!
@@ -368,6 +401,7 @@ def run(sampling_frequency=256.0,
     if training == True:
         train_samples = real_noise_array = []
         snrs = []
+        polarisations = []
         train_pars = np.zeros((N_gen,len(rand_pars)))
         for i in range(N_gen):
             
@@ -388,10 +422,14 @@ def run(sampling_frequency=256.0,
             #train_pars.append([temp])
 
             # make the data - shift geocent time to correct reference
-            train_samp_noisefree, train_samp_noisy,_,ifos,_ = gen_template(duration,sampling_frequency,
-                                                                           pars,ref_geocent_time,psd_files,
-                                                                           use_real_det_noise=use_real_det_noise
-                                                                           )
+            template = gen_template(duration,sampling_frequency,
+                                    pars,ref_geocent_time,psd_files,
+                                    use_real_det_noise=use_real_det_noise,
+                                    return_polarisations=store_polarisations
+                                    )
+            train_samp_noisefree, train_samp_noisy,_,ifos,_ = template[:5]
+            if store_polarisations:
+                polarisations.append(template[5])
             train_samples.append([train_samp_noisefree,train_samp_noisy])
             small_snr_list = [ifos[j].meta_data['optimal_SNR'] for j in range(len(pars['det']))]
             snrs.append(small_snr_list)
@@ -401,6 +439,8 @@ def run(sampling_frequency=256.0,
         train_samples_noisefree = np.array(train_samples)[:,0,:]
         snrs = np.array(snrs) 
 #        train_pars = np.array(train_pars)
+        if store_polarisations:
+            return train_samples_noisefree,train_pars,snrs,np.array(polarisations).astype(np.complex64),detector_info(ifos)
         return train_samples_noisefree,train_pars,snrs
 
     # otherwise we are doing test data 
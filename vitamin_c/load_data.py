@@ -4,13 +4,159 @@ import h5py
 import numpy as np
 import tensorflow as tf
 import time
-from lal import GreenwichMeanSiderealTime
-from astropy.time import Time
-from astropy import coordinates as coord
+import json
+import mmap
+import threading
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from lal import GreenwichMeanSiderealTime, C_SI
+from multirate import multirate, multirate_length
+
+class H5FilePool(object):
+    """
+    Bounded LRU pool of open read-only h5py files shared by all of the data readers.
+    Files that are currently being read are never evicted, and handles inherited
+    through a fork are dropped so the child process opens its own.
+    """
+
+    def __init__(self, max_open = 64):
+        self.max_open = max_open
+        self.hits = 0
+        self.misses = 0
+        self._files = OrderedDict()
+        self._in_use = {}
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    @contextmanager
+    def open(self, filename):
+        """
+        context manager giving an open read-only handle to filename
+        """
+        h5py_file = self.acquire(filename)
+        try:
+            yield h5py_file
+        finally:
+            self.release(filename)
+
+    def acquire(self, filename):
+        """
+        get an open handle to filename, opening it if it is not already in the pool
+        every acquire must be matched by a release
+        """
+        filename = os.path.abspath(filename)
+        with self._lock:
+            if os.getpid() != self._pid:
+                self._reset_after_fork()
+            if filename in self._files:
+                self._files.move_to_end(filename)
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._files[filename] = h5py.File(filename, 'r')
+            self._in_use[filename] = self._in_use.get(filename, 0) + 1
+            self._evict()
+            return self._files[filename]
+
+    def release(self, filename):
+        """
+        mark a handle from acquire as no longer being read
+        """
+        filename = os.path.abspath(filename)
+        with self._lock:
+            if filename in self._in_use:
+                self._in_use[filename] -= 1
+                if self._in_use[filename] <= 0:
+                    del self._in_use[filename]
+            self._evict()
+
+    def _evict(self):
+        """
+        close the least recently used handles that are not in use until the pool is within max_open
+        """
+        for filename in list(self._files.keys()):
+            if len(self._files) <= self.max_open:
+                break
+            if filename not in self._in_use:
+                self._files.pop(filename).close()
+
+    def close(self, filename = None):
+        """
+        close a single file, or all files in the pool if no filename is given
+        """
+        with self._lock:
+            filenames = list(self._files.keys()) if filename is None else [os.path.abspath(filename)]
+            for f in filenames:
+                if f in self._files:
+                    self._files.pop(f).close()
+                    self._in_use.pop(f, None)
+
+    def stats(self):
+        """
+        number of cache hits, misses and currently open files
+        """
+        return {"hits": self.hits, "misses": self.misses, "open": len(self._files)}
+
+    def _reset_after_fork(self):
+        # the parent's handles are not safe to use in the child, forget them without closing
+        self._files = OrderedDict()
+        self._in_use = {}
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+
+
+# shared pool used by all the loaders in this module
+h5_file_pool = H5FilePool()
+
+def read_rows(dataset, indices):
+    """
+    read sorted rows from an h5py dataset with one slice read per contiguous run of indices
+    """
+    runs = np.split(indices, np.where(np.diff(indices) != 1)[0] + 1)
+    if len(runs) == 1:
+        return dataset[runs[0][0]:runs[0][-1] + 1]
+    return np.concatenate([dataset[run[0]:run[-1] + 1] for run in runs], axis=0)
+
+def is_memory_mapped(array):
+    """
+    check whether an array is a memmap or a view of one, so its data lives in the page cache rather than the heap
+    """
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return isinstance(array, mmap.mmap)
+
+def detector_geometry(xp, hour_angle, dec, psi, detector_tensors, detector_vertices):
+    """
+    antenna patterns and arrival time delays from the geocentre for a batch of sky positions and polarisation angles
+    written for either numpy or tensorflow, passed as xp, following the bilby conventions
+    hour_angle, dec, psi: (num_templates,)
+    detector_tensors: (num_dets, 3, 3), detector_vertices: (num_dets, 3) in metres
+    returns f_plus, f_cross and delay, each (num_templates, num_dets)
+    """
+    phi = -1.0*hour_angle
+    theta = np.pi/2.0 - dec
+    u = xp.stack([xp.cos(phi)*xp.cos(theta), xp.cos(theta)*xp.sin(phi), -1.0*xp.sin(theta)], axis=-1)
+    v = xp.stack([-1.0*xp.sin(phi), xp.cos(phi), xp.zeros_like(phi)], axis=-1)
+    m = -1.0*u*xp.sin(psi)[:,None] - v*xp.cos(psi)[:,None]
+    n = -1.0*u*xp.cos(psi)[:,None] + v*xp.sin(psi)[:,None]
+    f_plus = xp.einsum('ni,dij,nj->nd', m, detector_tensors, m) - xp.einsum('ni,dij,nj->nd', n, detector_tensors, n)
+    f_cross = xp.einsum('ni,dij,nj->nd', m, detector_tensors, n) + xp.einsum('ni,dij,nj->nd', n, detector_tensors, m)
+    # unit vector towards the source, a detector closer to the source sees the signal earlier
+    omega = xp.stack([xp.sin(theta)*xp.cos(phi), xp.sin(theta)*xp.sin(phi), xp.cos(theta)], axis=-1)
+    delay = -1.0*xp.einsum('ni,di->nd', omega, detector_vertices)/C_SI
+    return f_plus, f_cross, delay
 
 class DataLoader(tf.keras.utils.Sequence):
 
-    def __init__(self, input_dir,  batch_size = 512, params=None, bounds=None, masks = None, fixed_vals = None, test_set = False, silent = True, chunk_batch = 40):
+    def __init__(self, input_dir,  batch_size = 512, params=None, bounds=None, masks = None, fixed_vals = None, test_set = False, silent = True, chunk_batch = 40, prefetch = False, shuffle = False, shuffle_block_size = 256, num_workers = 0, stall_tolerance = 0.5, raw_cache_bytes = 0, use_manifest = False, freq_domain = False, batch_augment = False, extrinsic = False, file_index = None):
         
         self.params = params
         self.bounds = bounds
@@ -19,15 +165,38 @@ class DataLoader(tf.keras.utils.Sequence):
         self.input_dir = input_dir
         self.test_set = test_set
         self.silent = silent
-        self.shuffle = False
+        self.shuffle = shuffle
+        self.shuffle_block_size = shuffle_block_size
         self.batch_size = batch_size
+        self.use_manifest = use_manifest
+        # checks the bands, batches are decimated as they are handed out
+        self.y_dim = multirate_length(self.params['multirate_bands'], self.params['ndata'])
 
-        #load all filenames
-        self.get_all_filenames()
+        #load all filenames, or take the shards, manifest and filenames already resolved by the parent loader
+        if file_index is not None:
+            self.shards, self.manifest, self.filenames = file_index
+        else:
+            self.get_all_filenames()
+        # if extrinsic, training files hold the unprojected plus and cross polarisations, which are projected
+        # onto the detectors at newly drawn sky positions, polarisation angles and arrival times
+        self.extrinsic = extrinsic and not self.test_set
+        if self.extrinsic and self.shards is not None:
+            print("Packed shards do not hold polarisations, not using extrinsic parameter augmentation")
+            self.extrinsic = False
+        if self.extrinsic:
+            self.load_detector_info()
         # get number of data examples as give them indicies
-        self.num_data = len(self.filenames)*self.params["tset_split"]
+        if self.shards is not None:
+            self.num_data = self.shards.num_data
+        elif self.manifest is not None:
+            self.num_data = self.manifest.num_data
+        else:
+            self.num_data = len(self.filenames)*self.params["tset_split"]
         self.num_dets = len(self.params["det"])
-        self.indices = np.arange(self.num_data)
+        # each pass over the data gets its own block shuffle drawn from a fixed seed, so future chunks can be resolved ahead of time
+        self.pass_num = 0
+        self.shuffle_seed = np.random.randint(2**31 - 1)
+        self.indices = self.get_pass_indices(self.pass_num)
 
         self.chunk_batch = chunk_batch
         self.chunk_size = self.batch_size*chunk_batch
@@ -37,6 +206,50 @@ class DataLoader(tf.keras.utils.Sequence):
         # will addthis to init files eventually
         self.params["noiseamp"] = 1
 
+        # if prefetching, the next chunk is built on a background thread while the current one is trained on
+        self.prefetch = prefetch
+        self.wait_time = 0.0
+        self.total_wait_time = 0.0
+        self._next_chunk = None
+        self._next_chunk_iter = None
+        self._executor = ThreadPoolExecutor(max_workers=1) if self.prefetch and not self.test_set else None
+
+        # if num_workers is not 0 chunks are assembled and augmented by a pool of worker processes
+        # num_workers="auto" forks os.cpu_count() workers once, as forking after the loader threads start is unsafe,
+        # and varies how many sub-chunks each chunk is split into from the measured trainer stall
+        # the stall is only separate from the load time when prefetching, without it every load stalls the trainer
+        # and all of the workers are used
+        self.autotune_workers = num_workers == "auto" and prefetch
+        self.max_workers = os.cpu_count() if num_workers == "auto" else int(num_workers)
+        self.num_workers = 1 if self.autotune_workers else self.max_workers
+        self.stall_tolerance = stall_tolerance
+        self._process_pool = None
+        if self.max_workers > 0 and not self.test_set:
+            self.start_worker_pool()
+
+        # raw noisefree chunks are kept so that they can be augmented again without reading from disk
+        # the worker processes read their sub-chunks themselves, so the cache in this process would never be filled
+        if raw_cache_bytes > 0 and self._process_pool is not None:
+            print("Loader worker processes read their own sub-chunks, not using the raw chunk cache")
+            raw_cache_bytes = 0
+        self.raw_cache = RawChunkCache(raw_cache_bytes)
+        # if freq_domain, raw chunks are kept as their rfft so augmentation only needs the inverse transform
+        # shards packed in the frequency domain are always used as stored
+        # otherwise the spectrum is only reused through the raw cache, without it the forward FFT runs on every chunk anyway
+        if freq_domain and raw_cache_bytes <= 0:
+            print("freq_domain_cache only saves the forward FFT of cached raw chunks, set raw_chunk_cache_gb above 0 to use it")
+            freq_domain = False
+        self.freq_domain = freq_domain or (self.shards is not None and self.shards.freq_domain)
+        # if batch_augment, chunks are held unaugmented and augment_batch is applied to each batch in the training graph
+        # the worker processes already augment off the training process, so they keep augmenting whole sub-chunks
+        self.batch_augment = batch_augment and not self.test_set and self._process_pool is None
+        if batch_augment and self._process_pool is not None:
+            print("Loader worker processes augment whole chunks, not using per batch augmentation")
+
+        # frequencies of the rfft bins, built once and shared by every augmentation
+        self.fvec = (np.arange(self.params['ndata']//2 + 1)/self.params['duration']).astype(np.float32)
+        self.chunk_indices = None
+
 
     def __len__(self):
         """ number of batches per epoch"""
@@ -46,30 +259,215 @@ class DataLoader(tf.keras.utils.Sequence):
     def load_next_chunk(self):
 
         if self.test_set:
-            self.X, self.Y_noisefree, self.Y_noisy, self.snrs = self.load_waveforms(self.filenames, None)
+            if self.shards is not None:
+                self.X, self.Y_noisefree, self.Y_noisy, self.snrs = self.prepare_data(self.shards.read(0, self.num_data))
+            else:
+                self.X, self.Y_noisefree, self.Y_noisy, self.snrs = self.load_waveforms(self.filenames, None)
         else:
             if self.chunk_iter >= self.max_chunk_num:
                 print("Reached maximum number of chunks, restarting index")
-                self.chunk_iter = 0
+                self.on_epoch_end()
 
             start_load = time.time()
             #print("Loading data from chunk {}".format(self.chunk_iter))
-            # get the data indices for given chunk
-            temp_chunk_indices = self.indices[self.chunk_iter*self.chunk_size:(self.chunk_iter + 1)*self.chunk_size]
-            # get the filenames which these data indices live, take set to get single file index
-            temp_filename_indices = np.array(list(set(np.floor(temp_chunk_indices/self.params["tset_split"])))).astype(int)
-            # rewrite the data indices as the index within each file
-            temp_chunk_indices = temp_chunk_indices % self.params["tset_split"]
-            # if the index falls to zero then split as the file is the next one 
-            temp_chunk_indices_split = np.split(temp_chunk_indices, np.where(np.diff(temp_chunk_indices) < 0)[0] + 1)
-            
-            self.X, self.Y_noisefree, self.Y_noisy, self.snrs = self.load_waveforms(self.filenames[temp_filename_indices], temp_chunk_indices_split)
+            if self.prefetch:
+                # only use the prefetched chunk if it is the one requested (indices may have been reset since)
+                if self._next_chunk is None or self._next_chunk_iter != (self.pass_num, self.chunk_iter):
+                    self._submit_chunk(self.pass_num, self.chunk_iter)
+                chunk = self._next_chunk.result()
+                # swap in the new chunk in a single assignment and start building the next one
+                self.X, self.Y_noisefree, self.Y_noisy, self.snrs = chunk
+                del chunk
+                if self.chunk_iter + 1 < self.max_chunk_num:
+                    self._submit_chunk(self.pass_num, self.chunk_iter + 1)
+                else:
+                    self._submit_chunk(self.pass_num + 1, 0)
+            else:
+                self.X, self.Y_noisefree, self.Y_noisy, self.snrs = self.load_chunk_data(self.get_chunk_indices(self.chunk_iter))
+            self.chunk_indices = self.get_chunk_indices(self.chunk_iter)
             
             end_load = time.time()
-            print("load_time chunk {}: {}".format(self.chunk_iter, end_load - start_load))
+            self.wait_time = end_load - start_load
+            self.total_wait_time += self.wait_time
+            if self.prefetch:
+                print("wait_time chunk {}: {}, total wait time: {}".format(self.chunk_iter, self.wait_time, self.total_wait_time))
+            else:
+                print("load_time chunk {}: {}".format(self.chunk_iter, self.wait_time))
+            if not self.silent:
+                print("h5 file handles: {}".format(h5_file_pool.stats()))
+            if self.autotune_workers:
+                self.tune_num_workers()
 
             self.chunk_iter += 1
-        
+
+    def get_pass_indices(self, pass_num):
+        """
+        get the order of the global data indices for a given pass over the data
+        if shuffling, fixed size contiguous blocks are permuted so reads stay close to sequential
+        """
+        if not self.shuffle or self.test_set:
+            return np.arange(self.num_data)
+        rng = np.random.RandomState((self.shuffle_seed + pass_num) % (2**32 - 1))
+        num_blocks = int(np.ceil(self.num_data/self.shuffle_block_size))
+        blocks = rng.permutation(num_blocks)
+        indices = (blocks[:,None]*self.shuffle_block_size + np.arange(self.shuffle_block_size)).ravel()
+        return indices[indices < self.num_data]
+
+    def get_chunk_indices(self, chunk_iter, pass_num = None):
+        """
+        get the global data indices for a given chunk, sorted so that they can be read sequentially
+        """
+        if pass_num is None or pass_num == self.pass_num:
+            indices = self.indices
+        else:
+            indices = self.get_pass_indices(pass_num)
+        return np.sort(indices[chunk_iter*self.chunk_size:(chunk_iter + 1)*self.chunk_size])
+
+    def get_chunk_files(self, chunk_indices):
+        """
+        get the filenames and the indices within each file for a set of sorted global data indices
+        """
+        # get the file which each of these data indices lives in and the index within that file
+        if self.manifest is not None:
+            # exact mapping from the row counts in the manifest
+            file_indices = np.searchsorted(self.manifest.offsets, chunk_indices, side='right') - 1
+            file_rows = chunk_indices - self.manifest.offsets[file_indices]
+        else:
+            file_indices = (chunk_indices // self.params["tset_split"]).astype(int)
+            file_rows = chunk_indices % self.params["tset_split"]
+        # split wherever the file changes
+        splits = np.where(np.diff(file_indices) != 0)[0] + 1
+        temp_filename_indices = file_indices[np.concatenate([[0], splits])]
+        temp_chunk_indices_split = np.split(file_rows, splits)
+
+        return self.filenames[temp_filename_indices], temp_chunk_indices_split
+
+    def read_chunk_data(self, chunk_indices):
+        """
+        read the raw data at the given sorted global indices
+        """
+        if self.shards is not None:
+            # packed shards serve the whole chunk with one contiguous read per shard
+            return self.shards.read_indices(chunk_indices)
+        filenames, indices = self.get_chunk_files(chunk_indices)
+        return self.read_waveforms(filenames, indices)
+
+    def load_chunk_data(self, chunk_indices):
+        """
+        load and augment the data at the given global indices
+        """
+        if self._process_pool is not None:
+            return self.load_chunk_data_workers(chunk_indices)
+        key = chunk_indices.tobytes()
+        data = self.raw_cache.get(key)
+        if data is None:
+            data = self.read_chunk_data(chunk_indices)
+            if self.freq_domain:
+                data = self.to_spectrum(data)
+            self.raw_cache.put(key, data)
+        # prepare_data normalises the parameters in place, so give it its own copy of them
+        return self.prepare_data(dict(data, x_data=np.array(data['x_data'])))
+
+    def to_spectrum(self, data):
+        """
+        replace the noisefree waveforms of a raw chunk with their rfft, (num_templates, num_dets, num_samples//2 + 1) complex64
+        """
+        if 'y_data_noisefree' not in data:
+            return data
+        data = dict(data)
+        y_data = data.pop('y_data_noisefree')
+        data['y_data_fft'] = tf.signal.rfft(tf.transpose(tf.cast(y_data, dtype=tf.float32),[0,2,1])).numpy()
+        return data
+
+    def refresh_chunk(self):
+        """
+        redraw the noise and the phase, time and distance randomisation of the current chunk
+        the raw chunk comes from the cache, so this only costs disk reads if it has been evicted
+        """
+        if self.chunk_indices is None:
+            self.load_next_chunk()
+            return
+        start_refresh = time.time()
+        self.X, self.Y_noisefree, self.Y_noisy, self.snrs = self.load_chunk_data(self.chunk_indices)
+        if not self.silent:
+            print("refresh_time chunk {}: {}, raw cache: {}".format(self.chunk_iter - 1, time.time() - start_refresh, self.raw_cache.stats()))
+
+    def start_worker_pool(self):
+        """
+        fork the worker processes that assemble and augment sub-chunks
+        the workers only use numpy and h5py, and are forked up front before any loader threads exist
+        """
+        self._process_pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context("fork"),
+                                                 initializer=_init_loader_worker,
+                                                 initargs=(self.input_dir, self.params, self.bounds, self.masks, self.extrinsic,
+                                                           (self.shards, self.manifest, self.filenames)))
+        # forked processes are all started on the first submission
+        self._process_pool.submit(int).result()
+
+    def load_chunk_data_workers(self, chunk_indices):
+        """
+        split a chunk into num_workers sub-chunks which are read and augmented in the worker processes
+        the workers write their rows straight into a shared memory block
+        """
+        num_rows = len(chunk_indices)
+        shape_x = (num_rows, len(self.params['inf_pars']))
+        shape_y = (num_rows, self.params['ndata'], self.num_dets)
+        nbytes = (np.prod(shape_x) + np.prod(shape_y))*np.dtype(np.float32).itemsize
+        shm = shared_memory.SharedMemory(create=True, size=int(nbytes))
+        try:
+            # the chunk is read in sorted order, shuffling is done by where the workers write each row
+            positions = np.random.permutation(num_rows) if self.shuffle else np.arange(num_rows)
+            splits = np.array_split(np.arange(num_rows), self.num_workers)
+            futures = [self._process_pool.submit(_load_sub_chunk, chunk_indices[split], positions[split], shm.name, shape_x, shape_y, np.random.randint(2**31 - 1)) for split in splits if len(split) > 0]
+            snrs = np.zeros((num_rows,) + futures[0].result().shape[1:])
+            for split, future in zip(splits, futures):
+                snrs[positions[split]] = future.result()
+
+            x_data, y_data = _shared_arrays(shm, shape_x, shape_y)
+            # one copy out of shared memory into tensorflow
+            x_data = tf.convert_to_tensor(x_data)
+            y_data = tf.convert_to_tensor(y_data)
+        finally:
+            shm.close()
+            shm.unlink()
+
+        return x_data, y_data, tf.constant([], dtype=tf.float32), snrs
+
+    def tune_num_workers(self):
+        """
+        adjust the number of worker processes used per chunk from the measured trainer stall
+        double the workers when the trainer waited too long, release one when it did not wait at all
+        """
+        if self.wait_time > self.stall_tolerance and self.num_workers < self.max_workers:
+            self.num_workers = min(2*self.num_workers, self.max_workers)
+            print("Trainer stalled for {}s, using {} loader workers".format(self.wait_time, self.num_workers))
+        elif self.wait_time < 0.1*self.stall_tolerance and self.num_workers > 1:
+            self.num_workers -= 1
+
+    def _submit_chunk(self, pass_num, chunk_iter):
+        """
+        start loading a chunk on the background worker
+        """
+        # wait for any chunk still in flight so only one extra chunk is held in memory
+        if self._next_chunk is not None:
+            self._next_chunk.result()
+        # resolve the indices in this thread so later changes to them cannot race with the worker
+        self._next_chunk = self._executor.submit(self.load_chunk_data, self.get_chunk_indices(chunk_iter, pass_num))
+        self._next_chunk_iter = (pass_num, chunk_iter)
+
+    def close(self):
+        """
+        stop the background worker and drop any prefetched chunk
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._next_chunk = None
+        self._next_chunk_iter = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True)
+            self._process_pool = None
 
     def __getitem__(self, index = 0):
         """
@@ -87,18 +485,21 @@ class DataLoader(tf.keras.utils.Sequence):
             #print(self.X.shape, self.Y_noisefree.shape, index, start_index, end_index, self.chunk_size, self.chunk_iter)
             X, Y_noisefree = self.X[start_index:end_index], self.Y_noisefree[start_index:end_index]
             
-        return np.array(Y_noisefree), np.array(X)
+        # the chunk is already float32 and channels last, so hand out the slices directly
+        # the augmented chunk is a new array, so these are views of it rather than of the shard memmaps
+        # unaugmented batches are decimated after augment_batch
+        if not self.batch_augment:
+            Y_noisefree = multirate(Y_noisefree, self.params['multirate_bands'])
+        return Y_noisefree, X
 
 
     def on_epoch_end(self):
         """Updates indices after each epoch
         """
-        self.indices = np.arange(self.num_data)
+        self.pass_num += 1
+        self.indices = self.get_pass_indices(self.pass_num)
         self.chunk_iter = 0
 
-        if self.shuffle == True:
-            np.random.shuffle(self.indices)
-
     def on_epoch_begin(self):
         """Updates indices after each epoch
         """
@@ -108,12 +509,41 @@ class DataLoader(tf.keras.utils.Sequence):
         """
         Get a list of all of the filenames containing the waveforms
         """
-        # Sort files by number index in file name using natsorted program
-        self.filenames = np.array(natsort.natsorted(os.listdir(self.input_dir),reverse=False))
+        self.shards = None
+        self.manifest = None
+        if ShardReader.is_sharded(self.input_dir):
+            # data packed by convert_to_shards, the index lists the shard files
+            self.shards = ShardReader(self.input_dir)
+            self.filenames = self.shards.filenames
+        elif self.use_manifest and not self.test_set:
+            # the manifest lists the valid files and their row counts
+            self.manifest = DataManifest.load_or_build(self.input_dir, verify_files = self.params["manifest_verify_files"])
+            self.filenames = self.manifest.filenames
+        else:
+            # Sort files by number index in file name using natsorted program
+            filenames = [f for f in os.listdir(self.input_dir) if f != DataManifest.manifest_filename]
+            self.filenames = np.array(natsort.natsorted(filenames,reverse=False))
         
+    def load_detector_info(self):
+        """
+        read the detector tensors, vertices and whitening filter stored with the polarisations by gen_train
+        """
+        keys = ['detector_tensors', 'detector_vertices', 'whitening_filter']
+        try:
+            with h5_file_pool.open(os.path.join(self.input_dir,self.filenames[0])) as h5py_file:
+                self.detectors = {k: h5py_file[k][:].astype(np.float32) for k in keys}
+        except KeyError:
+            raise ValueError("Training files in {} do not hold polarisations, generate them with store_polarisations".format(self.input_dir))
+
     def load_waveforms(self, filenames, indices = None):
         """
-        load all the data from the filenames paths
+        load, normalise and augment all the data from the filenames paths
+        """
+        return self.prepare_data(self.read_waveforms(filenames, indices))
+
+    def read_waveforms(self, filenames, indices = None):
+        """
+        read all the data from the filenames paths
         args
         ---------
         filenames : list
@@ -126,24 +556,27 @@ class DataLoader(tf.keras.utils.Sequence):
         y_data_noisy     : waveform with noise
         """
 
-        data={'x_data': [], 'y_data_noisefree': [], 'y_data_noisy': [], 'rand_pars': [], 'snrs': []}
+        data={'x_data': [], 'y_data_noisefree': [], 'y_data_polarisations': [], 'y_data_noisy': [], 'rand_pars': [], 'snrs': []}
 
         #idx = np.sort(np.random.choice(self.params["tset_split"],self.params["batch_size"],replace=False))
         
         for i,filename in enumerate(filenames):
             try:
-                h5py_file = h5py.File(os.path.join(self.input_dir,filename), 'r')
-                # dont like the below code, will rewrite at some point
-                if self.test_set:
-                    data['x_data'].append(h5py_file['x_data'])
-                    data['y_data_noisefree'].append([h5py_file['y_data_noisefree']])
-                    data['rand_pars'] = h5py_file['rand_pars']
-                    data['snrs'].append(h5py_file['snrs'])
-                else:
-                    data['x_data'].append(h5py_file['x_data'][indices[i]])
-                    data['y_data_noisefree'].append(h5py_file['y_data_noisefree'][indices[i]])
-                    data['rand_pars'] = [i for i in h5py_file['rand_pars']]
-                    data['snrs'].append(h5py_file['snrs'][indices[i]])
+                with h5_file_pool.open(os.path.join(self.input_dir,filename)) as h5py_file:
+                    # dont like the below code, will rewrite at some point
+                    if self.test_set:
+                        data['x_data'].append(h5py_file['x_data'][:])
+                        data['y_data_noisefree'].append([h5py_file['y_data_noisefree'][:]])
+                        data['rand_pars'] = h5py_file['rand_pars'][:]
+                        data['snrs'].append(h5py_file['snrs'][:])
+                    else:
+                        data['x_data'].append(read_rows(h5py_file['x_data'], indices[i]))
+                        if self.extrinsic:
+                            data['y_data_polarisations'].append(read_rows(h5py_file['y_data_polarisations'], indices[i]))
+                        else:
+                            data['y_data_noisefree'].append(read_rows(h5py_file['y_data_noisefree'], indices[i]))
+                        data['rand_pars'] = [i for i in h5py_file['rand_pars']]
+                        data['snrs'].append(read_rows(h5py_file['snrs'], indices[i]))
                 if not self.silent:
                     print('...... Loaded file ' + os.path.join(self.input_dir,filename))
             except OSError:
@@ -151,15 +584,66 @@ class DataLoader(tf.keras.utils.Sequence):
                 continue
 
         # concatentation all the x data (parameters) from each of the files
-        data['x_data'] = np.concatenate(np.array(data['x_data']), axis=0).squeeze()
-        # concatenate, then transpose the dimensions for keras, from (num_templates, num_dets, num_samples) to (num_templates, num_samples, num_dets)
-        data['y_data_noisefree'] = np.transpose(np.concatenate(np.array(data['y_data_noisefree']), axis=0),[0,2,1])
-        data['snrs'] = np.concatenate(np.array(data['snrs']), axis=0)
+        data['x_data'] = np.concatenate(data['x_data'], axis=0).squeeze()
+        if self.extrinsic:
+            # polarisations are kept as (num_templates, 2, num_samples//2 + 1) and projected when augmenting
+            data['y_data_polarisations'] = np.concatenate(data['y_data_polarisations'], axis=0)
+            del data['y_data_noisefree']
+        else:
+            # concatenate, then transpose the dimensions for keras, from (num_templates, num_dets, num_samples) to (num_templates, num_samples, num_dets)
+            data['y_data_noisefree'] = np.transpose(np.concatenate(data['y_data_noisefree'], axis=0),[0,2,1])
+            del data['y_data_polarisations']
+        data['snrs'] = np.concatenate(data['snrs'], axis=0)
+
+        return data
+
+    def prepare_data(self, data):
+        """
+        normalise, cast and augment a chunk of concatenated data
+        data: dictionary of x_data (num_templates, num_pars), y_data_noisefree (num_templates, num_samples, num_dets), y_data_noisy, rand_pars and snrs
+        """
+        # the chunk was read in sorted order, shuffle it in memory
+        if self.shuffle and not self.test_set:
+            perm = np.random.permutation(len(data['x_data']))
+            for key in ['x_data', 'y_data_noisefree', 'y_data_fft', 'y_data_polarisations', 'snrs']:
+                if key in data:
+                    data[key] = data[key][perm]
+
+        # normalise the parameters and keep only those to be inferred
+        data['x_data'] = self.normalise_pars(data['x_data'], data['rand_pars'])
 
+        # cast data to floats
+        data["x_data"] = tf.cast(data['x_data'],dtype=tf.float32)
+        data["y_data_noisy"] = tf.cast(data['y_data_noisy'],dtype=tf.float32)
+
+        # with per batch augmentation the chunk is handed out as it is and augmented in augment_batch
+        if self.batch_augment:
+            if 'y_data_polarisations' in data:
+                data["y_data_noisefree"] = tf.cast(data['y_data_polarisations'],dtype=tf.complex64)
+            elif 'y_data_fft' in data:
+                data["y_data_noisefree"] = tf.cast(data['y_data_fft'],dtype=tf.complex64)
+            else:
+                data["y_data_noisefree"] = tf.cast(data['y_data_noisefree'],dtype=tf.float32)
+        # project the polarisations at new extrinsic parameters and add noise
+        elif 'y_data_polarisations' in data:
+            data["x_data"], data["y_data_noisefree"] = self.augment_extrinsic(data["x_data"], tf.cast(data['y_data_polarisations'],dtype=tf.complex64))
+        # randomise phase, time and distance and add noise
+        elif 'y_data_fft' in data:
+            data["x_data"], data["y_data_noisefree"] = self.augment_spectrum(data["x_data"], tf.cast(data['y_data_fft'],dtype=tf.complex64))
+        else:
+            data["y_data_noisefree"] = tf.cast(data['y_data_noisefree'],dtype=tf.float32)
+            data["x_data"], data["y_data_noisefree"] = self.augment(data["x_data"], data["y_data_noisefree"])
+        
+        return data['x_data'], data['y_data_noisefree'], data['y_data_noisy'],data['snrs']
+
+    def normalise_pars(self, x_data, rand_pars):
+        """
+        convert ra to hour angle, normalise each parameter by its bounds and select the inference parameters
+        """
         # convert the parameters from right ascencsion to hour angle
-        data['x_data'] = convert_ra_to_hour_angle(data['x_data'], self.params, self.params['rand_pars'])
+        x_data = convert_ra_to_hour_angle(x_data, self.params, self.params['rand_pars'])
 
-        decoded_rand_pars, par_idx = self.get_infer_pars(data)
+        decoded_rand_pars, par_idx = self.get_infer_pars({'rand_pars': rand_pars})
 
         for i,k in enumerate(decoded_rand_pars):
             par_min = k + '_min'
@@ -167,35 +651,274 @@ class DataLoader(tf.keras.utils.Sequence):
 
             # Ensure that psi is between 0 and pi
             if par_min == 'psi_min':
-                data['x_data'][:,i] = np.remainder(data['x_data'][:,i], np.pi)
+                x_data[:,i] = np.remainder(x_data[:,i], np.pi)
 
             # normalize each parameter by its bounds
-            data['x_data'][:,i] = (data['x_data'][:,i] - self.bounds[par_min]) / (self.bounds[par_max] - self.bounds[par_min])
+            x_data[:,i] = (x_data[:,i] - self.bounds[par_min]) / (self.bounds[par_max] - self.bounds[par_min])
 
         if not self.silent:
-            print('...... {} will be inferred'.format(infparlist))
+            print('...... {} will be inferred'.format(', '.join(self.params['inf_pars'])))
 
-        # cast data to floats
-        data["x_data"] = tf.cast(data['x_data'][:,par_idx],dtype=tf.float32)
-        data["y_data_noisefree"] = tf.cast(data['y_data_noisefree'],dtype=tf.float32)
-        data["y_data_noisy"] = tf.cast(data['y_data_noisy'],dtype=tf.float32)
+        return x_data[:,par_idx]
 
-        # randomise phase, time and distance
-        
-        data["x_data"], time_correction = self.randomise_time(data["x_data"])
-        data["x_data"], phase_correction = self.randomise_phase(data["x_data"], data["y_data_noisefree"])
-        data["x_data"], distance_correction = self.randomise_distance(data["x_data"], data["y_data_noisefree"])
-        
-        # apply phase, time and distance corrections
-        y_temp_fft = tf.signal.rfft(tf.transpose(data["y_data_noisefree"],[0,2,1]))*phase_correction*time_correction
-        data["y_data_noisefree"] = tf.transpose(tf.signal.irfft(y_temp_fft),[0,2,1])*distance_correction
-        del y_temp_fft
+    def augment(self, x, y):
+        """
+        randomise the phase, time and distance of noisefree waveforms then add noise and normalise
+        x: normalised parameters (num_templates, num_pars)
+        y: noisefree waveforms (num_templates, num_samples, num_dets)
+        """
+        return self.augment_spectrum(x, tf.signal.rfft(tf.transpose(y,[0,2,1])))
+
+    def augment_spectrum(self, x, y_fft):
+        """
+        randomise the phase, time and distance of noisefree waveforms given as their rfft then add noise and normalise
+        x: normalised parameters (num_templates, num_pars)
+        y_fft: rfft of the noisefree waveforms (num_templates, num_dets, num_samples//2 + 1)
+        """
+        # randomise time, phase and distance
+        x, old_geocent, new_geocent = self.redraw_par(x, 'geocent_time', self.masks["geocent_idx_mask"][0])
+        x, old_phase, new_phase = self.redraw_par(x, 'phase', self.masks["phase_idx_mask"][0])
+        x, old_d, new_d = self.redraw_par(x, 'luminosity_distance', self.masks["dist_idx_mask"][0])
+
+        # one complex factor per template and frequency holding the time shift, phase shift and distance scaling
+        # broadcast over the detectors rather than tiled
+        shift = tf.expand_dims(new_phase - old_phase, 1) - 2.0*np.pi*tf.constant(self.fvec)*tf.expand_dims(new_geocent - old_geocent, 1)
+        scale = tf.expand_dims(-1.0*old_d/new_d, 1)
+        correction = tf.complex(scale*tf.cos(shift), scale*tf.sin(shift))
+        y = tf.transpose(tf.signal.irfft(y_fft*tf.expand_dims(correction, 1), fft_length=[self.params['ndata']]),[0,2,1])
         
         # add noise to the noisefree waveforms and normalise and normalise
         y_normscale = tf.cast(self.params['y_normscale'], dtype=tf.float32)
-        data["y_data_noisefree"] = (data["y_data_noisefree"] + self.params["noiseamp"]*tf.random.normal(shape=tf.shape(data["y_data_noisefree"]), mean=0.0, stddev=1.0, dtype=tf.float32))/y_normscale
-        
-        return data['x_data'], data['y_data_noisefree'], data['y_data_noisy'],data['snrs']
+        y = (y + self.params["noiseamp"]*tf.random.normal(shape=tf.shape(y), mean=0.0, stddev=1.0, dtype=tf.float32))/y_normscale
+
+        return x, y
+
+    def augment_extrinsic(self, x, pols):
+        """
+        project stored polarisations onto the detectors at newly drawn sky position, polarisation angle and arrival time,
+        randomise the phase and distance, then whiten, add noise and normalise
+        x: normalised parameters (num_templates, num_pars)
+        pols: frequency domain plus and cross polarisations (num_templates, 2, num_samples//2 + 1)
+        """
+        x, _, geocent = self.redraw_par(x, 'geocent_time', self.par_column('geocent_time'))
+        x, old_phase, new_phase = self.redraw_par(x, 'phase', self.masks["phase_idx_mask"][0])
+        x, old_d, new_d = self.redraw_par(x, 'luminosity_distance', self.masks["dist_idx_mask"][0])
+        x, _, hour_angle = self.redraw_par(x, 'ra', self.par_column('ra'))
+        x, _, psi = self.redraw_par(x, 'psi', self.par_column('psi'))
+        # declination is drawn uniform in sin(dec) as in the generation prior
+        sin_min, sin_max = np.sin(self.bounds['dec_min']), np.sin(self.bounds['dec_max'])
+        dec = tf.asin(sin_min + tf.random.uniform(shape=tf.shape(x)[:1], dtype=tf.float32)*(sin_max - sin_min))
+        x = self.set_par(x, self.par_column('dec'), (dec - self.bounds['dec_min'])/(self.bounds['dec_max'] - self.bounds['dec_min']))
+
+        f_plus, f_cross, delay = detector_geometry(tf, hour_angle, dec, psi, tf.constant(self.detectors['detector_tensors']), tf.constant(self.detectors['detector_vertices']))
+
+        # strain at each detector (num_templates, num_dets, num_samples//2 + 1)
+        h = tf.expand_dims(tf.cast(f_plus, tf.complex64), 2)*pols[:,None,0,:] + tf.expand_dims(tf.cast(f_cross, tf.complex64), 2)*pols[:,None,1,:]
+        # time shift to the arrival time in the segment, phase shift, distance scaling and whitening in one complex factor
+        dt = tf.expand_dims(geocent, 1) + 0.5*self.params['duration'] + delay
+        shift = tf.reshape(new_phase - old_phase, [-1,1,1]) - 2.0*np.pi*tf.constant(self.fvec)*tf.expand_dims(dt, 2)
+        scale = tf.reshape(-1.0*old_d/new_d, [-1,1,1])*tf.constant(self.detectors['whitening_filter'])
+        h = h*tf.complex(scale*tf.cos(shift), scale*tf.sin(shift))
+        y = np.sqrt(2.0*self.params['ndata'])*tf.transpose(tf.signal.irfft(h, fft_length=[self.params['ndata']]),[0,2,1])
+
+        # add noise to the noisefree waveforms and normalise
+        y_normscale = tf.cast(self.params['y_normscale'], dtype=tf.float32)
+        y = (y + self.params["noiseamp"]*tf.random.normal(shape=tf.shape(y), mean=0.0, stddev=1.0, dtype=tf.float32))/y_normscale
+
+        return x, y
+
+    def augment_extrinsic_numpy(self, x, pols, rng):
+        """
+        numpy version of augment_extrinsic used by the worker processes
+        x: normalised parameters (num_templates, num_pars)
+        pols: frequency domain plus and cross polarisations (num_templates, 2, num_samples//2 + 1)
+        """
+        x = np.array(x, dtype=np.float32)
+        num_rows = x.shape[0]
+
+        def redraw(par, idx, new_x = None):
+            par_min, par_max = self.bounds[par + '_min'], self.bounds[par + '_max']
+            old_par = None if idx is None else par_min + x[:,idx]*(par_max - par_min)
+            if new_x is None:
+                new_x = rng.uniform(0.0, 1.0, size=num_rows)
+            if idx is not None:
+                x[:,idx] = new_x
+            return old_par, par_min + new_x*(par_max - par_min)
+
+        _, geocent = redraw('geocent_time', self.par_column('geocent_time'))
+        old_phase, new_phase = redraw('phase', self.masks["phase_idx_mask"][0])
+        old_d, new_d = redraw('luminosity_distance', self.masks["dist_idx_mask"][0])
+        _, hour_angle = redraw('ra', self.par_column('ra'))
+        _, psi = redraw('psi', self.par_column('psi'))
+        sin_min, sin_max = np.sin(self.bounds['dec_min']), np.sin(self.bounds['dec_max'])
+        dec = np.arcsin(sin_min + rng.uniform(0.0, 1.0, size=num_rows)*(sin_max - sin_min))
+        redraw('dec', self.par_column('dec'), (dec - self.bounds['dec_min'])/(self.bounds['dec_max'] - self.bounds['dec_min']))
+
+        f_plus, f_cross, delay = detector_geometry(np, hour_angle, dec, psi, self.detectors['detector_tensors'], self.detectors['detector_vertices'])
+        h = f_plus[:,:,None]*pols[:,None,0,:] + f_cross[:,:,None]*pols[:,None,1,:]
+        dt = geocent[:,None] + 0.5*self.params['duration'] + delay
+        h *= np.exp(1.0j*((new_phase - old_phase)[:,None,None] - 2.0*np.pi*self.fvec*dt[:,:,None]))
+        h *= (-1.0*old_d/new_d)[:,None,None]*self.detectors['whitening_filter']
+        y = np.sqrt(2.0*self.params['ndata'])*np.transpose(np.fft.irfft(h, n=self.params['ndata'], axis=2),[0,2,1])
+
+        # add noise to the noisefree waveforms and normalise
+        y = (y + self.params["noiseamp"]*rng.standard_normal(size=y.shape))/self.params['y_normscale']
+
+        return x, y.astype(np.float32)
+
+    def augment_batch(self, y, x):
+        """
+        augment a batch handed out by __getitem__ when using per batch augmentation, returns (y, x) like __getitem__
+        traced into the training step so the augmentation runs in the same graph as the gradient step
+        y: noisefree waveforms (batch_size, num_samples, num_dets), their rfft (batch_size, num_dets, num_samples//2 + 1)
+           or the polarisations (batch_size, 2, num_samples//2 + 1) when using extrinsic augmentation
+        """
+        if self.extrinsic:
+            x, y = self.augment_extrinsic(x, y)
+        elif y.dtype.is_complex:
+            x, y = self.augment_spectrum(x, y)
+        else:
+            x, y = self.augment(x, y)
+        return multirate(y, self.params['multirate_bands']), x
+
+    def augment_numpy(self, x, y, rng):
+        """
+        numpy version of augment used by the worker processes, which must not use tensorflow after the fork
+        x: normalised parameters (num_templates, num_pars)
+        y: noisefree waveforms (num_templates, num_samples, num_dets) or their complex rfft (num_templates, num_dets, num_samples//2 + 1)
+        """
+        x = np.array(x, dtype=np.float32)
+        num_rows = x.shape[0]
+
+        # randomise time
+        idx = self.masks["geocent_idx_mask"][0]
+        old_geocent = self.bounds['geocent_time_min'] + x[:,idx]*(self.bounds['geocent_time_max'] - self.bounds['geocent_time_min'])
+        x[:,idx] = rng.uniform(0.0, 1.0, size=num_rows)
+        new_geocent = self.bounds['geocent_time_min'] + x[:,idx]*(self.bounds['geocent_time_max'] - self.bounds['geocent_time_min'])
+        correction = np.exp(-2.0j*np.pi*self.fvec[None,:]*(new_geocent-old_geocent)[:,None])
+
+        # randomise phase
+        idx = self.masks["phase_idx_mask"][0]
+        old_phase = self.bounds['phase_min'] + x[:,idx]*(self.bounds['phase_max'] - self.bounds['phase_min'])
+        x[:,idx] = rng.uniform(0.0, 1.0, size=num_rows)
+        new_phase = self.bounds['phase_min'] + x[:,idx]*(self.bounds['phase_max'] - self.bounds['phase_min'])
+        correction *= -1.0*np.exp(1.0j*(new_phase-old_phase))[:,None]
+
+        # randomise distance
+        idx = self.masks["dist_idx_mask"][0]
+        old_d = self.bounds['luminosity_distance_min'] + x[:,idx]*(self.bounds['luminosity_distance_max'] - self.bounds['luminosity_distance_min'])
+        x[:,idx] = rng.uniform(0.0, 1.0, size=num_rows)
+        new_d = self.bounds['luminosity_distance_min'] + x[:,idx]*(self.bounds['luminosity_distance_max'] - self.bounds['luminosity_distance_min'])
+        correction *= (old_d/new_d)[:,None]
+
+        # apply phase, time and distance corrections along the time axis
+        if np.iscomplexobj(y):
+            y = np.transpose(np.fft.irfft(y*correction[:,None,:], n=self.params['ndata'], axis=2),[0,2,1])
+        else:
+            y_fft = np.fft.rfft(y, axis=1)*correction[:,:,None]
+            y = np.fft.irfft(y_fft, n=self.params['ndata'], axis=1)
+            del y_fft
+
+        # add noise to the noisefree waveforms and normalise
+        y = (y + self.params["noiseamp"]*rng.standard_normal(size=y.shape))/self.params['y_normscale']
+
+        return x, y.astype(np.float32)
+
+    def read_file(self, filename):
+        """
+        generator yielding the normalised parameters and noisefree waveforms from a single file
+        """
+        if isinstance(filename, bytes):
+            filename = filename.decode('utf-8')
+        try:
+            with h5_file_pool.open(os.path.join(self.input_dir,filename)) as h5py_file:
+                rand_pars = h5py_file['rand_pars'][:]
+                num_rows = h5py_file['x_data'].shape[0]
+                spectrum = self.shards is not None and self.shards.freq_domain
+                # large packed shards are read in blocks of tset_split rows
+                for start in range(0, num_rows, self.params["tset_split"]):
+                    x_data = h5py_file['x_data'][start:start + self.params["tset_split"]]
+                    if spectrum:
+                        y_data = h5py_file['y_data_fft'][start:start + self.params["tset_split"]].astype(np.complex64, copy=False)
+                    else:
+                        y_data = h5py_file['y_data_noisefree'][start:start + self.params["tset_split"]]
+                        # transpose for keras, from (num_templates, num_dets, num_samples) to (num_templates, num_samples, num_dets)
+                        if self.shards is None or not self.shards.channels_last:
+                            y_data = np.transpose(y_data,[0,2,1])
+                        y_data = y_data.astype(np.float32, copy=False)
+                    x_data = self.normalise_pars(x_data, rand_pars).astype(np.float32)
+                    yield x_data, y_data
+        except OSError:
+            print('Could not load requested file')
+            return
+
+    def read_shard_range(self, start):
+        """
+        read the normalised parameters and waveforms of the shard samples in [start, start + tset_split)
+        the waveforms are channels last float32 or their complex64 rfft for shards packed in the frequency domain
+        """
+        data = self.shards.read(int(start), int(start) + self.params["tset_split"])
+        x_data = self.normalise_pars(np.array(data['x_data']), data['rand_pars']).astype(np.float32)
+        if self.shards.freq_domain:
+            y_data = np.ascontiguousarray(data['y_data_fft'], dtype=np.complex64)
+        else:
+            y_data = np.ascontiguousarray(data['y_data_noisefree'], dtype=np.float32)
+        return x_data, y_data
+
+    def get_tf_dataset(self, shuffle_buffer = None):
+        """
+        build a streaming tf.data pipeline over all files in input_dir
+        files are read with a parallel interleave, shuffled, batched, augmented in a mapped stage and prefetched
+        returns batches of (y, x) in the same order as __getitem__
+        per file readers are python generators and packed shards are read by index range through tf.numpy_function,
+        both hold the GIL and HDF5 reads also hold the h5py lock, so the parallel stages mostly overlap reading
+        with augmentation and training rather than reading on several cores at once
+        extrinsic parameter augmentation and the frequency domain raw cache are only supported by the chunked loader
+        """
+        if self.extrinsic:
+            raise ValueError("The tf.data pipeline does not support extrinsic parameter augmentation, use the chunked loader")
+        if self.freq_domain and not (self.shards is not None and self.shards.freq_domain):
+            raise ValueError("The tf.data pipeline does not use the frequency domain raw cache, use the chunked loader or pack the shards with pack_freq_domain")
+        if shuffle_buffer is None:
+            shuffle_buffer = self.chunk_size
+
+        # shards packed in the frequency domain are streamed as spectra
+        spectrum = self.shards is not None and self.shards.freq_domain
+        if spectrum:
+            y_spec = tf.TensorSpec(shape=(None, self.num_dets, self.params['ndata']//2 + 1), dtype=tf.complex64)
+        else:
+            y_spec = tf.TensorSpec(shape=(None, self.params['ndata'], self.num_dets), dtype=tf.float32)
+        signature = (tf.TensorSpec(shape=(None, len(self.params['inf_pars'])), dtype=tf.float32), y_spec)
+
+        if self.shards is not None:
+            starts = np.arange(0, self.shards.num_data, self.params["tset_split"])
+            dataset = tf.data.Dataset.from_tensor_slices(starts)
+            if not self.test_set:
+                dataset = dataset.shuffle(len(starts), reshuffle_each_iteration=True)
+
+            def read_range(start):
+                x_data, y_data = tf.numpy_function(self.read_shard_range, [start], [tf.float32, y_spec.dtype])
+                x_data.set_shape(signature[0].shape)
+                y_data.set_shape(y_spec.shape)
+                return x_data, y_data
+            dataset = dataset.map(read_range, num_parallel_calls = tf.data.AUTOTUNE, deterministic = self.test_set)
+        else:
+            dataset = tf.data.Dataset.from_tensor_slices(self.filenames)
+            if not self.test_set:
+                dataset = dataset.shuffle(len(self.filenames), reshuffle_each_iteration=True)
+
+            dataset = dataset.interleave(lambda filename: tf.data.Dataset.from_generator(self.read_file, args=(filename,), output_signature=signature),
+                                         cycle_length = tf.data.AUTOTUNE,
+                                         num_parallel_calls = tf.data.AUTOTUNE,
+                                         deterministic = self.test_set)
+        dataset = dataset.unbatch()
+        if not self.test_set:
+            dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+        dataset = dataset.batch(self.batch_size, drop_remainder = not self.test_set)
+        dataset = dataset.map(self.augment_spectrum if spectrum else self.augment, num_parallel_calls = tf.data.AUTOTUNE, deterministic = self.test_set)
+        dataset = dataset.map(lambda x, y: (multirate(y, self.params['multirate_bands']), x))
+
+        return dataset.prefetch(tf.data.AUTOTUNE)
 
 
     def get_infer_pars(self,data):
@@ -219,50 +942,462 @@ class DataLoader(tf.keras.utils.Sequence):
         return decoded_rand_pars, par_idx
 
 
-    def randomise_phase(self, x, y):
-        """ randomises phase of input parameter x"""
-        # get old phase and define new phase
-        old_phase = self.bounds['phase_min'] + tf.boolean_mask(x,self.masks["phase_mask"],axis=1)*(self.bounds['phase_max'] - self.bounds['phase_min'])
-        new_x = tf.random.uniform(shape=tf.shape(old_phase), minval=0.0, maxval=1.0, dtype=tf.dtypes.float32)
-        new_phase = self.bounds['phase_min'] + new_x*(self.bounds['phase_max'] - self.bounds['phase_min'])
-        # defice 
-        x = tf.gather(tf.concat([tf.reshape(tf.boolean_mask(x,self.masks["not_phase_mask"],axis=1),[-1,tf.shape(x)[1]-1]), tf.reshape(new_x,[-1,1])],axis=1),tf.constant(self.masks["idx_phase_mask"]),axis=1)
+    def par_column(self, par):
+        """
+        column of par in the normalised parameters, None if it is not inferred
+        """
+        return self.params['inf_pars'].index(par) if par in self.params['inf_pars'] else None
+
+    def set_par(self, x, idx, new_x):
+        """
+        replace column idx of x with new_x, leaves x unchanged if idx is None
+        """
+        if idx is None:
+            return x
+        return tf.where(tf.one_hot(idx, tf.shape(x)[1], on_value=True, off_value=False, dtype=tf.bool), tf.expand_dims(new_x, 1), x)
+
+    def redraw_par(self, x, par, idx):
+        """
+        redraw the normalised parameter par in column idx of x uniformly
+        returns the new x and the old and new values of the parameter within its bounds
+        parameters that are not inferred (idx is None) are drawn without an old value
+        """
+        par_min, par_max = self.bounds[par + '_min'], self.bounds[par + '_max']
+        old_par = None if idx is None else par_min + x[:,idx]*(par_max - par_min)
+        new_x = tf.random.uniform(shape=tf.shape(x)[:1], minval=0.0, maxval=1.0, dtype=tf.dtypes.float32)
+        x = self.set_par(x, idx, new_x)
+        return x, old_par, par_min + new_x*(par_max - par_min)
 
-        phase_correction = -1.0*tf.complex(tf.cos(new_phase-old_phase),tf.sin(new_phase-old_phase))
-        phase_correction = tf.tile(tf.expand_dims(phase_correction,axis=1),(1,self.num_dets,tf.shape(y)[1]/2 + 1))
-        return x, phase_correction
 
-    def randomise_time(self, x):
+class RawChunkCache(object):
+    """
+    Size bounded LRU cache of raw noisefree chunks keyed by their data indices.
+    A max_bytes of 0 disables the cache.
+    """
 
-        old_geocent = self.bounds['geocent_time_min'] + tf.boolean_mask(x,self.masks["geocent_mask"],axis=1)*(self.bounds['geocent_time_max'] - self.bounds['geocent_time_min'])
-        new_x = tf.random.uniform(shape=tf.shape(old_geocent), minval=0.0, maxval=1.0, dtype=tf.dtypes.float32)
-        
-        new_geocent = self.bounds['geocent_time_min'] + new_x*(self.bounds['geocent_time_max'] - self.bounds['geocent_time_min'])
+    def __init__(self, max_bytes = 0):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
 
-        x = tf.gather(tf.concat([tf.reshape(tf.boolean_mask(x,self.masks["not_geocent_mask"],axis=1),[-1,tf.shape(x)[1]-1]), tf.reshape(new_x,[-1,1])],axis=1),tf.constant(self.masks["idx_geocent_mask"]),axis=1)
+    @staticmethod
+    def data_nbytes(data):
+        """
+        bytes of a chunk held in memory, memory mapped shard waveforms are backed by the file and not counted
+        """
+        return sum(v.nbytes for v in data.values() if isinstance(v, np.ndarray) and not is_memory_mapped(v))
+
+    def get(self, key):
+        with self._lock:
+            if key in self._chunks:
+                self._chunks.move_to_end(key)
+                self.hits += 1
+                return self._chunks[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, data):
+        nbytes = self.data_nbytes(data)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._chunks:
+                return
+            self._chunks[key] = data
+            self.nbytes += nbytes
+            # evict the least recently used chunks until the cache fits
+            while self.nbytes > self.max_bytes:
+                _, old_data = self._chunks.popitem(last=False)
+                self.nbytes -= self.data_nbytes(old_data)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "chunks": len(self._chunks), "bytes": self.nbytes}
 
-        fvec = tf.range(self.params['ndata']/2 + 1, dtype = tf.dtypes.float32)/self.params['duration']
 
-        time_correction = -2.0*np.pi*fvec*(new_geocent-old_geocent)
-        time_correction = tf.complex(tf.cos(time_correction),tf.sin(time_correction))
-        time_correction = tf.tile(tf.expand_dims(time_correction,axis=1),(1,self.num_dets,1))
-        
-        return x, time_correction
-        
-    def randomise_distance(self,x, y):
+###############
+## Loader worker processes
+###############
+
+# loader used by each worker process, created once by the pool initializer
+_worker_loader = None
+
+def _init_loader_worker(input_dir, params, bounds, masks, extrinsic, file_index):
+    """
+    file_index holds the parent's shards, manifest and filenames, so the workers do not list, verify or rebuild them
+    """
+    global _worker_loader
+    _worker_loader = DataLoader(input_dir, params=params, bounds=bounds, masks=masks, silent=True, extrinsic=extrinsic, file_index=file_index)
+
+def _shared_arrays(shm, shape_x, shape_y):
+    """
+    views of the parameter and waveform arrays in a shared memory block
+    """
+    x_data = np.ndarray(shape_x, dtype=np.float32, buffer=shm.buf)
+    y_data = np.ndarray(shape_y, dtype=np.float32, buffer=shm.buf, offset=x_data.nbytes)
+    return x_data, y_data
+
+def _attach_shared_memory(name):
+    """
+    attach to a shared memory block owned by the parent without registering it with a resource tracker
+    a forked worker can share the parent's tracker, so unregistering there would drop the parent's entry
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # track was added in python 3.13
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+def _load_sub_chunk(chunk_indices, positions, shm_name, shape_x, shape_y, seed):
+    """
+    read, normalise and augment a sub-chunk in a worker process and write it into shared memory
+    returns the snrs of the sub-chunk
+    """
+    data = _worker_loader.read_chunk_data(chunk_indices)
+    x_data = _worker_loader.normalise_pars(data['x_data'], data['rand_pars'])
+    if 'y_data_polarisations' in data:
+        x_data, y_data = _worker_loader.augment_extrinsic_numpy(x_data, data['y_data_polarisations'], np.random.default_rng(seed))
+    else:
+        y_data = data['y_data_fft'] if 'y_data_fft' in data else data['y_data_noisefree']
+        x_data, y_data = _worker_loader.augment_numpy(x_data, y_data, np.random.default_rng(seed))
 
-        old_d = self.bounds['luminosity_distance_min'] + tf.boolean_mask(x,self.masks["dist_mask"],axis=1)*(self.bounds['luminosity_distance_max'] - self.bounds['luminosity_distance_min'])
-        new_x = tf.random.uniform(shape=tf.shape(old_d), minval=0.0, maxval=1.0, dtype=tf.dtypes.float32)
-        new_d = self.bounds['luminosity_distance_min'] + new_x*(self.bounds['luminosity_distance_max'] - self.bounds['luminosity_distance_min'])
-        x = tf.gather(tf.concat([tf.reshape(tf.boolean_mask(x,self.masks["not_dist_mask"],axis=1),[-1,tf.shape(x)[1]-1]), tf.reshape(new_x,[-1,1])],axis=1),tf.constant(self.masks["idx_dist_mask"]),axis=1)
-        dist_scale = tf.tile(tf.expand_dims(old_d/new_d,axis=1),(1,tf.shape(y)[1],1))
+    shm = _attach_shared_memory(shm_name)
+    shared_x, shared_y = _shared_arrays(shm, shape_x, shape_y)
+    shared_x[positions] = x_data
+    shared_y[positions] = y_data
+    del shared_x, shared_y
+    shm.close()
 
-        return x, dist_scale
+    return data['snrs']
 
 
+###############
+## Dataset manifest
+###############
 
+def _manifest_entry(path):
+    """
+    row count, shapes, dtypes and size/mtime fingerprint of a single data file
+    """
+    stat = os.stat(path)
+    entry = {"size": stat.st_size, "mtime": stat.st_mtime, "shapes": {}, "dtypes": {}}
+    try:
+        with h5py.File(path, 'r') as h5py_file:
+            for key in DataManifest.keys:
+                entry["shapes"][key] = list(h5py_file[key].shape)
+                entry["dtypes"][key] = str(h5py_file[key].dtype)
+    except (OSError, KeyError):
+        entry["shapes"] = None
+    return entry
+
+
+class DataManifest(object):
+    """
+    Manifest of a directory of training files with the row count, shape, dtype and a
+    size/mtime fingerprint of every file. It is built once in parallel, saved next to
+    the data and gives an exact mapping from global sample index to file. Files which
+    cannot be read or do not match the other files are left out of the mapping.
+    """
 
+    manifest_filename = "data_manifest.json"
+    keys = ['x_data', 'y_data_noisefree', 'snrs']
 
+    def __init__(self, input_dir, manifest):
+        self.input_dir = input_dir
+        self.manifest = manifest
+        self.filenames = np.array(manifest["filenames"])
+        self.rows = np.array(manifest["rows"], dtype=int)
+        self.offsets = np.concatenate([[0], np.cumsum(self.rows)])
+        self.num_data = int(self.offsets[-1])
+
+    @classmethod
+    def load_or_build(cls, input_dir, num_workers = None, verify_files = 64):
+        """
+        load the manifest for input_dir, building it if it is missing or the directory has changed since
+        verify_files random files have their fingerprint checked on loading, -1 checks every file
+        """
+        path = os.path.join(input_dir, cls.manifest_filename)
+        if os.path.isfile(path):
+            with open(path, 'r') as fp:
+                manifest = json.load(fp)
+            # files added or removed change the directory mtime, files rewritten in place change their own fingerprint
+            # checking a random sample of files keeps loading to a few stat calls on very large directories
+            if manifest["dir_mtime"] == os.stat(input_dir).st_mtime:
+                data_manifest = cls(input_dir, manifest)
+                changed = data_manifest.verify(None if verify_files < 0 else verify_files)
+                if len(changed) == 0:
+                    return data_manifest
+                print('...... {} files in {} changed since the data manifest was built, rebuilding'.format(len(changed), input_dir))
+            else:
+                print('...... Data manifest for {} is out of date, rebuilding'.format(input_dir))
+        return cls.build(input_dir, num_workers = num_workers)
+
+    @classmethod
+    def build(cls, input_dir, num_workers = None):
+        """
+        read the metadata of every file in input_dir in parallel and save the manifest
+        """
+        start_build = time.time()
+        filenames = natsort.natsorted([f for f in os.listdir(input_dir) if f not in [cls.manifest_filename, ShardReader.index_filename]],reverse=False)
+        paths = [os.path.join(input_dir, filename) for filename in filenames]
+        num_workers = num_workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("fork")) as pool:
+            entries = list(pool.map(_manifest_entry, paths, chunksize=max(1, len(paths)//(4*num_workers))))
+
+        # the first readable file defines the expected per sample shapes and dtypes
+        reference = next((entry for entry in entries if entry["shapes"] is not None), None)
+        if reference is None:
+            raise ValueError("No readable data files found in {}".format(input_dir))
+        shapes = {key: reference["shapes"][key][1:] for key in cls.keys}
+
+        manifest = {"dir_mtime": None, "shapes": shapes, "dtypes": reference["dtypes"],
+                    "filenames": [], "rows": [], "sizes": [], "mtimes": [], "skipped": []}
+        for filename, entry in zip(filenames, entries):
+            valid = entry["shapes"] is not None and entry["dtypes"] == reference["dtypes"]
+            if valid:
+                num_rows = entry["shapes"]['x_data'][0]
+                valid = all(entry["shapes"][key][0] == num_rows and entry["shapes"][key][1:] == shapes[key] for key in cls.keys)
+            if not valid:
+                manifest["skipped"].append(filename)
+                continue
+            manifest["filenames"].append(filename)
+            manifest["rows"].append(num_rows)
+            manifest["sizes"].append(entry["size"])
+            manifest["mtimes"].append(entry["mtime"])
+
+        if len(manifest["skipped"]) > 0:
+            print('...... Skipping {} unreadable or inconsistent files in {}'.format(len(manifest["skipped"]), input_dir))
+
+        path = os.path.join(input_dir, cls.manifest_filename)
+        try:
+            with open(path, 'w') as fp:
+                json.dump(manifest, fp)
+            manifest["dir_mtime"] = os.stat(input_dir).st_mtime
+            # the directory mtime is only known after the manifest is written, so write it again
+            with open(path, 'w') as fp:
+                json.dump(manifest, fp)
+        except OSError:
+            print('...... Could not write data manifest to {}, using it for this run only'.format(path))
+        print('...... Built data manifest for {} files in {}s'.format(len(filenames), time.time() - start_build))
+
+        return cls(input_dir, manifest)
+
+    def verify(self, num_files = None):
+        """
+        check the size/mtime fingerprint of num_files random files in the manifest, or of every file if None,
+        returns the files that have changed
+        """
+        entries = list(zip(self.manifest["filenames"], self.manifest["sizes"], self.manifest["mtimes"]))
+        if num_files is not None and num_files < len(entries):
+            entries = [entries[i] for i in np.sort(np.random.choice(len(entries), num_files, replace=False))]
+        changed = []
+        for filename, size, mtime in entries:
+            path = os.path.join(self.input_dir, filename)
+            if not os.path.isfile(path):
+                changed.append(filename)
+                continue
+            stat = os.stat(path)
+            if stat.st_size != size or stat.st_mtime != mtime:
+                changed.append(filename)
+        return changed
+
+
+###############
+## Packed shard format
+###############
+
+class ShardReader(object):
+    """
+    Reader for training data packed into a few large shards by convert_to_shards.
+    Each shard holds contiguous x_data, y_data_noisefree and snrs arrays and the
+    shard index maps global sample indices to shards, so any index range is served
+    with one contiguous read per shard it touches. Shards written channels last in
+    float32 are memory mapped, so contiguous reads of the waveforms are views. This
+    only removes the read, transpose and cast copies, DataLoader still shuffles,
+    casts and augments every chunk into new arrays.
+    """
+
+    index_filename = "shard_index.json"
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, self.index_filename), 'r') as fp:
+            self.index = json.load(fp)
+        self.filenames = np.array([shard["filename"] for shard in self.index["shards"]])
+        self.offsets = np.array([0] + [shard["start"] + shard["count"] for shard in self.index["shards"]])
+        self.num_data = int(self.offsets[-1])
+        self.rand_pars = np.array([k.encode('utf-8') for k in self.index["rand_pars"]])
+        # waveforms are either stored as generated (num_templates, num_dets, num_samples), channels last
+        # or as their complex64 rfft (num_templates, num_dets, num_samples//2 + 1)
+        self.y_layout = self.index.get("y_layout", "channels_first")
+        self.channels_last = self.y_layout == "channels_last"
+        self.freq_domain = self.y_layout == "freq_domain"
+        self.y_key = 'y_data_fft' if self.freq_domain else 'y_data_noisefree'
+        self._memmaps = {}
+
+    def get_memmap(self, shard):
+        """
+        memory map the waveforms of a shard, returns None if the dataset is not stored contiguously
+        """
+        if shard not in self._memmaps:
+            filename = os.path.join(self.shard_dir, self.filenames[shard])
+            with h5_file_pool.open(filename) as h5py_file:
+                dataset = h5py_file[self.y_key]
+                offset = dataset.id.get_offset()
+                if offset is None:
+                    self._memmaps[shard] = None
+                else:
+                    self._memmaps[shard] = np.memmap(filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+        return self._memmaps[shard]
+
+    @classmethod
+    def is_sharded(cls, input_dir):
+        """
+        check whether a directory contains packed shards
+        """
+        return os.path.isfile(os.path.join(input_dir, cls.index_filename))
+
+    def read(self, start, stop):
+        """
+        read all samples in the global index range [start, stop)
+        """
+        return self.read_indices(np.arange(start, min(stop, self.num_data)))
+
+    def read_indices(self, indices):
+        """
+        read the samples at the given global indices, returned in ascending index order
+        the indices are split into contiguous runs within each shard and each run is a single slice read
+        """
+        indices = np.unique(indices)
+        if len(indices) == 0:
+            raise ValueError("No indices requested from shards in {}".format(self.shard_dir))
+        data = {'x_data': [], self.y_key: [], 'snrs': []}
+        shard_idx = np.searchsorted(self.offsets, indices, side='right') - 1
+        # start a new read wherever the shard changes or the indices stop being contiguous
+        breaks = np.where((np.diff(indices) != 1) | (np.diff(shard_idx) != 0))[0] + 1
+        for run in np.split(np.arange(len(indices)), breaks):
+            shard = shard_idx[run[0]]
+            start = indices[run[0]] - self.offsets[shard]
+            stop = indices[run[-1]] - self.offsets[shard] + 1
+            memmap = self.get_memmap(shard) if self.channels_last or self.freq_domain else None
+            with h5_file_pool.open(os.path.join(self.shard_dir, self.filenames[shard])) as h5py_file:
+                for key in data:
+                    if key == self.y_key and memmap is not None:
+                        data[key].append(memmap[start:stop])
+                    else:
+                        data[key].append(h5py_file[key][start:stop])
+
+        for key in data:
+            # a single run is kept as a view rather than copied
+            data[key] = data[key][0] if len(data[key]) == 1 else np.concatenate(data[key], axis=0)
+        # keep the same layout as the chunks from DataLoader.load_waveforms
+        if self.y_layout == "channels_first":
+            data['y_data_noisefree'] = np.transpose(data['y_data_noisefree'],[0,2,1])
+        data['y_data_noisy'] = []
+        data['rand_pars'] = self.rand_pars
+
+        return data
+
+
+def convert_to_shards(input_dir, output_dir, samples_per_shard = int(1e5), channels_last = False, freq_domain = False, silent = False):
+    """
+    Pack a directory of training files written by gen_train into a few large shards
+
+    args
+    ---------
+    input_dir : str
+        directory of data_<i>-<N>.h5py training files
+    output_dir : str
+        directory to write the shards and the shard index to
+    samples_per_shard : int
+        approximate number of samples per shard, files are never split between shards
+    channels_last : bool
+        if True store the waveforms as float32 (num_templates, num_samples, num_dets) so they can be memory mapped without transposing or casting
+    freq_domain : bool
+        if True store the complex64 rfft of the waveforms (num_templates, num_dets, num_samples//2 + 1) instead of the time series, takes precedence over channels_last
+    """
+    filenames = natsort.natsorted([f for f in os.listdir(input_dir) if f not in [DataManifest.manifest_filename, ShardReader.index_filename]],reverse=False)
+
+    # first pass only reads the metadata to get the number of samples in each file
+    source_files = []
+    rand_pars = None
+    for filename in filenames:
+        try:
+            with h5_file_pool.open(os.path.join(input_dir,filename)) as h5py_file:
+                count = h5py_file['x_data'].shape[0]
+                if rand_pars is None:
+                    rand_pars = [k.decode('utf-8') for k in h5py_file['rand_pars'][:]]
+                    shapes = {key: h5py_file[key].shape[1:] for key in ['x_data', 'y_data_noisefree', 'snrs']}
+                    dtypes = {key: h5py_file[key].dtype for key in ['x_data', 'y_data_noisefree', 'snrs']}
+                    if freq_domain:
+                        num_dets, num_samples = shapes.pop('y_data_noisefree')
+                        del dtypes['y_data_noisefree']
+                        shapes['y_data_fft'] = (num_dets, num_samples//2 + 1)
+                        dtypes['y_data_fft'] = np.dtype(np.complex64)
+                    elif channels_last:
+                        shapes['y_data_noisefree'] = shapes['y_data_noisefree'][::-1]
+                        dtypes['y_data_noisefree'] = np.dtype(np.float32)
+        except (OSError, KeyError):
+            print('Could not load requested file {}, skipping'.format(filename))
+            continue
+        source_files.append({"filename": filename, "count": int(count)})
+
+    if len(source_files) == 0:
+        raise ValueError("No training files found in {}".format(input_dir))
+
+    # group consecutive files into shards
+    groups = [[]]
+    group_count = 0
+    for source in source_files:
+        if group_count >= samples_per_shard:
+            groups.append([])
+            group_count = 0
+        groups[-1].append(source)
+        group_count += source["count"]
+
+    os.makedirs(output_dir, exist_ok=True)
+    shards = []
+    start = 0
+    for shard_num, group in enumerate(groups):
+        shard_filename = "shard_{}.h5py".format(shard_num)
+        count = sum(source["count"] for source in group)
+        # datasets without chunking or compression are stored contiguously
+        with h5py.File(os.path.join(output_dir, shard_filename), 'w') as hf:
+            for key in shapes:
+                hf.create_dataset(key, shape=(count,) + shapes[key], dtype=dtypes[key])
+            hf.create_dataset('rand_pars', data=np.array([k.encode('utf-8') for k in rand_pars]))
+            row = 0
+            for source in group:
+                with h5_file_pool.open(os.path.join(input_dir,source["filename"])) as h5py_file:
+                    for key in shapes:
+                        if key == 'y_data_fft':
+                            hf[key][row:row + source["count"]] = np.fft.rfft(h5py_file['y_data_noisefree'][:], axis=2).astype(np.complex64)
+                        elif key == 'y_data_noisefree' and channels_last:
+                            hf[key][row:row + source["count"]] = np.transpose(h5py_file[key][:],[0,2,1]).astype(np.float32)
+                        else:
+                            hf[key][row:row + source["count"]] = h5py_file[key][:]
+                row += source["count"]
+        h5_file_pool.close(os.path.join(output_dir, shard_filename))
+        shards.append({"filename": shard_filename, "start": start, "count": count, "source_files": [source["filename"] for source in group]})
+        start += count
+        if not silent:
+            print('...... Packed {} files into {}'.format(len(group), os.path.join(output_dir, shard_filename)))
+
+    if freq_domain:
+        y_layout = "freq_domain"
+    else:
+        y_layout = "channels_last" if channels_last else "channels_first"
+    with open(os.path.join(output_dir, ShardReader.index_filename), 'w') as fp:
+        json.dump({"num_data": start, "rand_pars": rand_pars, "y_layout": y_layout, "shards": shards}, fp, indent=4)
+
+    return start
 
 
 ###############
@@ -310,12 +1445,13 @@ def load_data(params,bounds,fixed_vals,input_dir,inf_pars,test_data=False,silent
                 print('File not consistent beetween samplers')
                 continue
         try:
-            data['x_data'].append(h5py.File(dataLocations[0]+'/'+filename, 'r')['x_data'][:])
-            data['y_data_noisefree'].append(h5py.File(dataLocations[0]+'/'+filename, 'r')['y_data_noisefree'][:])
-            if test_data:
-                data['y_data_noisy'].append(h5py.File(dataLocations[0]+'/'+filename, 'r')['y_data_noisy'][:])
-            data['rand_pars'] = h5py.File(dataLocations[0]+'/'+filename, 'r')['rand_pars'][:]
-            data['snrs'].append(h5py.File(dataLocations[0]+'/'+filename, 'r')['snrs'][:])
+            with h5_file_pool.open(dataLocations[0]+'/'+filename) as h5py_file:
+                data['x_data'].append(h5py_file['x_data'][:])
+                data['y_data_noisefree'].append(h5py_file['y_data_noisefree'][:])
+                if test_data:
+                    data['y_data_noisy'].append(h5py_file['y_data_noisy'][:])
+                data['rand_pars'] = h5py_file['rand_pars'][:]
+                data['snrs'].append(h5py_file['snrs'][:])
             if not silent:
                 print('...... Loaded file ' + dataLocations[0] + '/' + filename)
         except OSError:
@@ -373,149 +1509,159 @@ def load_data(params,bounds,fixed_vals,input_dir,inf_pars,test_data=False,silent
 
     return data['x_data'], tf.cast(data['y_data_noisefree'],dtype=tf.float32), tf.cast(data['y_data_noisy'],dtype=tf.float32), data['snrs']
 
+@lru_cache(maxsize=None)
+def greenwich_sidereal_time(gps_time):
+    """
+    Greenwich mean sidereal time in radians wrapped to [0, 2 pi) at the given gps time, cached per reference time
+    lal returns the unwrapped angle, the wrap matches astropy's sidereal_time and bilby
+    """
+    return float(GreenwichMeanSiderealTime(float(gps_time))) % (2.0*np.pi)
+
+def _ra_column(pars):
+    """
+    index of the RA column in data, or None if RA is fixed
+    """
+    if pars is None or 'ra' not in list(pars):
+        print('...... RA is fixed. Not converting RA to hour angle.')
+        return None
+    return list(pars).index('ra')
+
+def _convert_ra_column(data, ra_idx, fn):
+    """
+    apply fn to the RA column of a numpy array or tensorflow tensor in one vectorised operation
+    """
+    if tf.is_tensor(data):
+        mask = tf.one_hot(ra_idx, tf.shape(data)[1], dtype=tf.bool)
+        return tf.where(mask, fn(data), data)
+    data[:,ra_idx] = fn(data[:,ra_idx])
+    return data
+
 def convert_ra_to_hour_angle(data, params, pars, single=False):
     """
     Converts right ascension to hour angle and back again
     """
-
-    greenwich = coord.EarthLocation.of_site('greenwich')
-    t = Time(params['ref_geocent_time'], format='gps', location=greenwich)
-    t = t.sidereal_time('mean', 'greenwich').radian
+    t = greenwich_sidereal_time(params['ref_geocent_time'])
 
     # compute single instance
     if single:
         return t - data
 
-    for i,k in enumerate(pars):
-        if k == 'ra':
-            ra_idx = i
-
-    # Check if RA exist
-    try:
-        ra_idx
-    except NameError:
-        print('...... RA is fixed. Not converting RA to hour angle.')
-    else:
-        # Iterate over all training samples and convert to hour angle
-        for i in range(data.shape[0]):
-            data[i,ra_idx] = t - data[i,ra_idx]
-
-    return data
+    ra_idx = _ra_column(pars)
+    if ra_idx is None:
+        return data
+    return _convert_ra_column(data, ra_idx, lambda ra: t - ra)
 
 def convert_hour_angle_to_ra(data, params, pars, single=False):
     """
     Converts right ascension to hour angle and back again
     """
-    greenwich = coord.EarthLocation.of_site('greenwich')
-    t = Time(params['ref_geocent_time'], format='gps', location=greenwich)
-    t = t.sidereal_time('mean', 'greenwich').radian
+    t = greenwich_sidereal_time(params['ref_geocent_time'])
 
     # compute single instance
     if single:
         return np.remainder(t - data,2.0*np.pi)
 
-    for i,k in enumerate(pars):
-        if k == 'ra':
-            ra_idx = i
+    ra_idx = _ra_column(pars)
+    if ra_idx is None:
+        return data
+    if tf.is_tensor(data):
+        return _convert_ra_column(data, ra_idx, lambda ha: tf.math.floormod(t - ha, 2.0*np.pi))
+    return _convert_ra_column(data, ra_idx, lambda ha: np.remainder(t - ha, 2.0*np.pi))
 
-    # Check if RA exist
-    try:
-        ra_idx
-    except NameError:
-        print('...... RA is fixed. Not converting RA to hour angle.')
-    else:
-        # Iterate over all training samples and convert to hour angle
-        for i in range(data.shape[0]):
-            data[i,ra_idx] = np.remainder(t - data[i,ra_idx],2.0*np.pi)
-
-    return data
 
+def _sampler_dir(params, sampler):
+    """
+    directory holding the posterior samples of one sampler
+    """
+    return '%s_%s' % (params['pe_dir'],sampler+'1')
 
-def load_samples(params,sampler,pp_plot=False, bounds=None):
+def posterior_index(params, samplers=None):
     """
-    read in pre-computed posterior samples
+    test case indices that have a posterior file for every sampler, found with a single directory listing per sampler
     """
-    if type("%s" % params['pe_dir']) is str:
-        # load generated samples back in
-        dataLocations = '%s_%s' % (params['pe_dir'],sampler+'1')
-        print('... looking in {} for posterior samples'.format(dataLocations))
-    else:
+    if samplers is None:
+        samplers = params['samplers'][1:]
+    label = params['bilby_results_label'] + '_'
+    available = None
+    for sampler in samplers:
+        found = set()
+        try:
+            with os.scandir(_sampler_dir(params, sampler)) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if name.startswith(label) and name.endswith('.h5py'):
+                        num = name[len(label):-len('.h5py')]
+                        if num.isdigit():
+                            found.add(int(num))
+        except FileNotFoundError:
+            pass
+        available = found if available is None else available & found
+    return sorted(available) if available else []
+
+def _read_posterior(filename, params, pp_plot, bounds, seed):
+    """
+    read all of the *_post datasets of one posterior file and return n_samples rows of shape (n_samples, n_pars)
+    """
+    with h5_file_pool.open(filename) as h5py_file:
+        columns = [h5py_file[q + '_post'][:] for q in params['bilby_pars']]
+    Nsamp = columns[0].shape[0]
+
+    rand_idx_posterior = np.linspace(0,Nsamp-1,num=params['n_samples'],dtype=int)
+    np.random.RandomState(seed).shuffle(rand_idx_posterior)
+
+    XS = np.empty((params['n_samples'],len(columns)))
+    for j,(q,d) in enumerate(zip(params['bilby_pars'],columns)):
+        d = d[rand_idx_posterior]
+        if q == 'psi':
+            d = np.remainder(d,np.pi)
+        elif q == 'geocent_time':
+            d = d - params['ref_geocent_time']
+        # Convert samples to hour angle if doing pp plot
+        if q == 'ra' and pp_plot:
+            d = convert_ra_to_hour_angle(d, params, None, single=True)
+        if bounds is not None:
+            d = (d - bounds[q + '_min']) / (bounds[q + '_max'] - bounds[q + '_min'])
+        XS[:,j] = d
+    return XS
+
+def load_all_samples(params, samplers=None, pp_plot=False, bounds=None, num_threads=None):
+    """
+    read in pre-computed posterior samples for several samplers at once, returns an array of shape (n_samplers, r, n_samples, n_pars)
+
+    Row i holds test case i, so every one of the first r test cases needs a posterior from every sampler,
+    otherwise a ValueError lists the missing ones. All files are read in parallel on a thread pool.
+    """
+    if samplers is None:
+        samplers = params['samplers'][1:]
+    if not isinstance(params['pe_dir'], str):
         print('ERROR: input samples directory not a string')
         exit(0)
 
-    # Iterate over requested number of testing samples to use
-#    for i in range(params['r']):
-    i = i_idx = 0
-    for samp_idx,samp in enumerate(params['samplers'][1:]):
-        if samp == sampler:
-            samp_idx = samp_idx
-            break
-    while i_idx < params['r']:
-
-        filename = '%s/%s_%d.h5py' % (dataLocations,params['bilby_results_label'],i)
-        for samp_idx_inner in params['samplers'][1:]:
-            inner_file_existance = True
-            if samp_idx_inner == samp_idx:
-                inner_file_existance = os.path.isfile(filename)
-                if inner_file_existance == False:
-                    break
-                else:
-                    continue
-
-            dataLocations_inner = '%s_%s' % (params['pe_dir'],samp_idx_inner+'1')
-            filename_inner = '%s/%s_%d.h5py' % (dataLocations_inner,params['bilby_results_label'],i)
-            # If file does not exist, skip to next file
-            inner_file_existance = os.path.isfile(filename_inner)                
-            if inner_file_existance == False:
-                break
-
-        if inner_file_existance == False:
-            i+=1
-            print('File does not exist for one of the samplers')
-            continue
-        #if not os.path.isfile(filename):
-        #    print('... unable to find file {}. Exiting.'.format(filename))
-        #    exit(0)
-
-        print('... Loading test sample -> ' + filename)
-        data_temp = {}
-        n = 0
-
-        # Retrieve all source parameters to do inference on
-        for q in params['bilby_pars']:
-            p = q + '_post'
-            par_min = q + '_min'
-            par_max = q + '_max'
-            data_temp[p] = h5py.File(filename, 'r')[p][:]
-            if p == 'psi_post':
-                data_temp[p] = np.remainder(data_temp[p],np.pi)
-            elif p == 'geocent_time_post':
-                data_temp[p] = data_temp[p] - params['ref_geocent_time']
-            # Convert samples to hour angle if doing pp plot
-            if p == 'ra_post' and pp_plot:
-                data_temp[p] = convert_ra_to_hour_angle(data_temp[p], params, None, single=True)
-            data_temp[p] = (data_temp[p] - bounds[par_min]) / (bounds[par_max] - bounds[par_min])
-            Nsamp = data_temp[p].shape[0]
-            n = n + 1
-        print('... read in {} samples from {}'.format(Nsamp,filename))
-
-        # place retrieved source parameters in numpy array rather than dictionary
-        j = 0
-        XS = np.zeros((Nsamp,n))
-        for p,d in data_temp.items():
-            XS[:,j] = d
-            j += 1
-        print('... put the samples in an array')
-
-        # Append test sample posteriors to existing array of other test sample posteriors
-        rand_idx_posterior = np.linspace(0,Nsamp-1,num=params['n_samples'],dtype=np.int)
-        np.random.shuffle(rand_idx_posterior)
-        rand_idx_posterior = rand_idx_posterior[:params['n_samples']]
-        
-        if i == 0:
-            XS_all = np.expand_dims(XS[rand_idx_posterior,:], axis=0)
-        else:
-            XS_all = np.vstack((XS_all,np.expand_dims(XS[rand_idx_posterior,:], axis=0)))
-        print('... appended {} samples to the total'.format(params['n_samples']))
-        i+=1; i_idx+=1
+    # index over every sampler so that test cases line up between separate calls
+    index_samplers = list(params['samplers'][1:]) + [s for s in samplers if s not in params['samplers'][1:]]
+    # callers line the rows up with the test set, so test cases cannot be skipped
+    available = set(posterior_index(params, index_samplers))
+    test_idx = list(range(params['r']))
+    missing = [i for i in test_idx if i not in available]
+    if len(missing) > 0:
+        raise ValueError('Test cases {} of the requested {} have no posterior from every one of {} in {}'.format(missing, params['r'], ', '.join(index_samplers), params['pe_dir']))
+
+    XS_all = np.zeros((len(samplers),len(test_idx),params['n_samples'],len(params['bilby_pars'])))
+    seeds = np.random.randint(0, 2**31 - 1, size=XS_all.shape[:2])
+
+    def fill(s, i):
+        filename = '%s/%s_%d.h5py' % (_sampler_dir(params, samplers[s]),params['bilby_results_label'],test_idx[i])
+        XS_all[s,i] = _read_posterior(filename, params, pp_plot, bounds, seeds[s,i])
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [executor.submit(fill, s, i) for s in range(len(samplers)) for i in range(len(test_idx))]
+        for f in futures:
+            f.result()
+    print('... read in {} test case posteriors for {}'.format(len(test_idx),', '.join(samplers)))
     return XS_all
+
+def load_samples(params,sampler,pp_plot=False, bounds=None):
+    """
+    read in pre-computed posterior samples
+    """
+    return load_all_samples(params, [sampler], pp_plot=pp_plot, bounds=bounds)[0]
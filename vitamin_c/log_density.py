@@ -0,0 +1,129 @@
+import time
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+tfd = tfp.distributions
+
+LOG_2PI = np.log(2.0*np.pi)
+
+def diag_gaussian_log_prob(x, mean, scale):
+    """Log density of a diagonal Gaussian summed over the last axis."""
+    return -tf.reduce_sum(0.5*tf.square((x - mean)/scale) + tf.math.log(scale), axis=-1) - 0.5*LOG_2PI*tf.cast(tf.shape(x)[-1], x.dtype)
+
+def diag_gaussian_entropy(scale):
+    """Entropy of a diagonal Gaussian summed over the last axis."""
+    return tf.reduce_sum(tf.math.log(scale), axis=-1) + 0.5*(1.0 + LOG_2PI)*tf.cast(tf.shape(scale)[-1], scale.dtype)
+
+def gaussian_mixture_log_prob(z, mean, scale, logweight):
+    """Log density of z (batch, z_dim) under a mixture of diagonal Gaussians with
+    mean and scale (batch, n_modes, z_dim) and unnormalised log weights (batch, n_modes)."""
+    return tf.reduce_logsumexp(tf.nn.log_softmax(logweight, axis=-1) + diag_gaussian_log_prob(z[:,None,:], mean, scale), axis=-1)
+
+def von_mises_log_prob(x, loc, concentration):
+    """Elementwise von Mises log density, log I0 is taken from the exponentially scaled Bessel function."""
+    return concentration*(tf.math.cos(x - loc) - 1.0) - LOG_2PI - tf.math.log(tf.math.bessel_i0e(concentration))
+
+def recon_log_prob(x, mean, scale, nonperiodic_idx, periodic_idx):
+    """Log density of the normalised parameters x under the r2 output, Gaussian in the
+    nonperiodic parameters and von Mises on [0,1) in the periodic ones."""
+    gauss = diag_gaussian_log_prob(tf.gather(x, nonperiodic_idx, axis=-1),
+                                   tf.gather(mean, nonperiodic_idx, axis=-1),
+                                   tf.gather(scale, nonperiodic_idx, axis=-1))
+    two_pi_scale = 2.0*np.pi*tf.gather(scale, periodic_idx, axis=-1)
+    vm = von_mises_log_prob(2.0*np.pi*tf.gather(x, periodic_idx, axis=-1),
+                            2.0*np.pi*tf.gather(mean, periodic_idx, axis=-1),
+                            tf.math.reciprocal(tf.square(two_pi_scale)))
+    # the log(2 pi) maps the von Mises density from angles onto the unit interval
+    return gauss + tf.reduce_sum(vm + LOG_2PI, axis=-1)
+
+def sample_von_mises(loc, concentration, n_iter=16, wrapped_normal_above=1e3):
+    """Draw one von Mises sample per element of loc and concentration, returns angles in [-pi,pi) about loc.
+
+    Uses Best-Fisher rejection with n_iter candidates drawn at once for every element, the
+    first accepted candidate is kept. Elements with concentration above wrapped_normal_above,
+    where the rejection step loses float32 precision and the density is Gaussian to O(1/kappa),
+    and the rare elements with no accepted candidate use a wrapped normal with variance 1/kappa.
+    """
+    shape = tf.shape(loc)
+    kappa = tf.maximum(concentration, 1e-6)
+    tau = 1.0 + tf.sqrt(1.0 + 4.0*tf.square(kappa))
+    rho = 2.0*kappa/(tau + tf.sqrt(2.0*tau))
+    r = (1.0 + tf.square(rho))/(2.0*rho)
+
+    u = tf.random.uniform(tf.concat([[3, n_iter], shape], axis=0), dtype=loc.dtype)
+    z = tf.math.cos(np.pi*u[0])
+    f = tf.clip_by_value((1.0 + r*z)/(r + z), -1.0, 1.0)
+    c = kappa*(r - f)
+    accept = (c*(2.0 - c) - u[1] > 0.0) | (tf.math.log(c/u[1]) + 1.0 - c >= 0.0)
+    theta = tf.sign(u[2] - 0.5)*tf.math.acos(f)
+    # index of the first accepted candidate, elements with none are replaced below
+    first = tf.argmax(tf.cast(accept, tf.int32), axis=0, output_type=tf.int32)
+    found = tf.reduce_any(accept, axis=0)
+    theta = tf.reduce_sum(tf.where(tf.equal(tf.range(n_iter)[:,None], tf.reshape(first, [1,-1])),
+                                   tf.reshape(theta, [n_iter,-1]), 0.0), axis=0)
+    theta = tf.reshape(theta, shape)
+
+    wrapped = tf.math.floormod(tf.random.normal(shape, dtype=loc.dtype)*tf.math.rsqrt(kappa) + np.pi, 2.0*np.pi) - np.pi
+    theta = tf.where(found & (kappa <= wrapped_normal_above), theta, wrapped)
+    return tf.math.floormod(loc + theta + np.pi, 2.0*np.pi) - np.pi
+
+def check_von_mises_sampler(concentrations=(0.1,1.0,10.0,100.0,1e3,1e5), n=100000, seed=0):
+    """Kolmogorov-Smirnov distance between the TFP von Mises cdf and samples from
+    sample_von_mises and from TFP, for a zero location and each concentration."""
+    tf.random.set_seed(seed)
+    result = {}
+    for kappa in concentrations:
+        vm = tfd.VonMises(loc=0.0, concentration=float(kappa))
+        ecdf = (np.arange(n) + 0.5)/n
+        fast = np.sort(sample_von_mises(tf.zeros(n), tf.fill([n], float(kappa))).numpy())
+        ref = np.sort(vm.sample(n).numpy())
+        result[kappa] = dict(fast=np.max(np.abs(vm.cdf(fast).numpy() - ecdf)),
+                             tfp=np.max(np.abs(vm.cdf(ref).numpy() - ecdf)))
+    return result
+
+def benchmark_von_mises_sampler(concentrations=(1.0,100.0,1e4), shape=(1000,250,5), repeats=5):
+    """Seconds per call of sample_von_mises and of TFP VonMises.sample inside a tf.function."""
+    fast = tf.function(lambda loc, kappa: sample_von_mises(loc, kappa))
+    ref = tf.function(lambda loc, kappa: tfd.VonMises(loc=loc, concentration=kappa).sample())
+    print('{:>10s} {:>12s} {:>12s}'.format('kappa','fast (s)','tfp (s)'))
+    result = {}
+    for kappa in concentrations:
+        loc = tf.zeros(shape)
+        kappa_t = tf.fill(shape, float(kappa))
+        times = []
+        for sampler in (fast, ref):
+            sampler(loc, kappa_t)   # trace
+            start = time.time()
+            for _ in range(repeats):
+                sampler(loc, kappa_t).numpy()
+            times.append((time.time() - start)/repeats)
+        result[kappa] = times
+        print('{:>10.1e} {:>12.4f} {:>12.4f}'.format(kappa, *times))
+    return result
+
+def compare_with_tfp(batch=256, x_dim=15, z_dim=10, n_modes=16, n_periodic=5, seed=0):
+    """Evaluate the fused densities and their TFP counterparts on random inputs,
+    returns the maximum absolute difference for each term."""
+    rng = np.random.RandomState(seed)
+    z = tf.constant(rng.normal(size=(batch, z_dim)), dtype=tf.float32)
+    mean_r1 = tf.constant(rng.normal(size=(batch, n_modes, z_dim)), dtype=tf.float32)
+    scale_r1 = tf.constant(np.exp(rng.normal(size=(batch, n_modes, z_dim))), dtype=tf.float32)
+    logweight_r1 = tf.constant(rng.normal(size=(batch, n_modes)), dtype=tf.float32)
+    x = tf.constant(rng.uniform(size=(batch, x_dim)), dtype=tf.float32)
+    mean_r2 = tf.constant(rng.uniform(size=(batch, x_dim)), dtype=tf.float32)
+    scale_r2 = tf.constant(np.exp(rng.uniform(-4.0, 0.0, size=(batch, x_dim))), dtype=tf.float32)
+    periodic_idx = list(range(x_dim - n_periodic, x_dim))
+    nonperiodic_idx = list(range(x_dim - n_periodic))
+
+    gm_r1 = tfd.MixtureSameFamily(mixture_distribution=tfd.Categorical(logits=logweight_r1),
+                                  components_distribution=tfd.MultivariateNormalDiag(loc=mean_r1, scale_diag=scale_r1))
+    mvn_r2 = tfd.MultivariateNormalDiag(loc=tf.gather(mean_r2, nonperiodic_idx, axis=-1),
+                                        scale_diag=tf.gather(scale_r2, nonperiodic_idx, axis=-1))
+    vm_r2 = tfd.VonMises(loc=2.0*np.pi*tf.gather(mean_r2, periodic_idx, axis=-1),
+                         concentration=tf.math.reciprocal(tf.square(2.0*np.pi*tf.gather(scale_r2, periodic_idx, axis=-1))))
+    recon_tfp = mvn_r2.log_prob(tf.gather(x, nonperiodic_idx, axis=-1)) + \
+                tf.reduce_sum(LOG_2PI + vm_r2.log_prob(2.0*np.pi*tf.gather(x, periodic_idx, axis=-1)), axis=-1)
+
+    return dict(r1_log_prob=np.max(np.abs(gaussian_mixture_log_prob(z, mean_r1, scale_r1, logweight_r1) - gm_r1.log_prob(z))),
+                q_entropy=np.max(np.abs(diag_gaussian_entropy(scale_r1[:,0]) - tfd.MultivariateNormalDiag(loc=mean_r1[:,0], scale_diag=scale_r1[:,0]).entropy())),
+                recon_log_prob=np.max(np.abs(recon_log_prob(x, mean_r2, scale_r2, nonperiodic_idx, periodic_idx) - recon_tfp)))
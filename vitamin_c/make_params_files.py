@@ -390,6 +390,58 @@ def get_params():
         __definition__weighted_pars='set to None if not using, parameters to weight during training',
         weighted_pars_factor=1,                       
         __definition__weighted_pars_factor='factor by which to weight weighted parameters',
+        prefetch_chunks=False,
+        __definition__prefetch_chunks='if True, load the next training chunk on a background thread while the current chunk is trained on',
+        tf_data_pipeline=False,
+        __definition__tf_data_pipeline='if True, stream training data through a tf.data pipeline instead of loading it in chunks',
+        samples_per_shard=int(1e5),
+        __definition__samples_per_shard='approximate number of samples in each packed training data shard',
+        shuffle_training_data=False,
+        __definition__shuffle_training_data='if True, block shuffle the training data between passes over the training set',
+        shuffle_block_size=256,
+        __definition__shuffle_block_size='number of contiguous training samples kept together when block shuffling',
+        pack_channels_last=True,
+        __definition__pack_channels_last='if True, packed training shards store the waveforms as float32 channels last so they can be memory mapped',
+        loader_workers=0,
+        __definition__loader_workers='number of worker processes used to assemble and augment training chunks, 0 to load in the training process or "auto" to adjust to the measured trainer stall',
+        loader_stall_tolerance=0.5,
+        __definition__loader_stall_tolerance='trainer wait per chunk in seconds above which the auto loader adds more workers',
+        raw_chunk_cache_gb=0,
+        __definition__raw_chunk_cache_gb='size in GB of the cache of raw noisefree training chunks, 0 disables the cache, not used with loader_workers',
+        echo_augmentation=False,
+        __definition__echo_augmentation='if True, redraw the noise and the phase, time and distance randomisation of the current training chunk every epoch',
+        use_data_manifest=False,
+        __definition__use_data_manifest='if True, use a manifest of the training and validation files, built once, for fast startup and exact index mapping',
+        manifest_verify_files=64,
+        __definition__manifest_verify_files='number of random files whose size and mtime are checked against a cached data manifest on loading, -1 checks every file',
+        freq_domain_cache=False,
+        __definition__freq_domain_cache='if True, keep raw training chunks as the rfft of the waveforms so augmentation skips the forward FFT, needs raw_chunk_cache_gb above 0',
+        pack_freq_domain=False,
+        __definition__pack_freq_domain='if True, the packed training shards store the complex64 rfft of the waveforms instead of the time series',
+        per_batch_augmentation=False,
+        __definition__per_batch_augmentation='if True, training chunks are kept unaugmented and each batch is augmented inside the compiled training step',
+        store_polarisations=False,
+        __definition__store_polarisations='if True, training files also store the unprojected plus and cross polarisations and the detector information',
+        extrinsic_augmentation=False,
+        __definition__extrinsic_augmentation='if True, project the stored polarisations onto the detectors at newly drawn ra, dec, psi and geocent_time for every chunk',
+        in_bounds_sampling=False,
+        __definition__in_bounds_sampling='if True, only keep posterior samples inside the prior bounds with mass_1 >= mass_2, refilling until the requested number is drawn',
+        latent_sampling='iid',
+        __definition__latent_sampling='how the r1 latent samples are drawn when generating posteriors, iid or sobol (randomised quasi-Monte Carlo)',
+        antithetic_latent=False,
+        __definition__antithetic_latent='if True, draw the r1 latent samples in antithetic pairs mirrored about their mixture component mean',
+        von_mises_sampler='tfp',
+        __definition__von_mises_sampler='sampler for the periodic parameters when generating posteriors, tfp or best_fisher (vectorised fixed-iteration rejection with a wrapped normal at high concentration)',
+        conv_trunk='default',
+        __definition__conv_trunk='shared convolutional trunk, default (the original three Conv1D layers) or params (built from n_filters_r1, filter_size_r1, conv_strides_r1, conv_dilations_r1, maxpool_r1 and pool_strides_r1)',
+        trunk_pooling='flatten',
+        __definition__trunk_pooling='reduction of the last trunk feature map when conv_trunk is params, flatten, global_average or global_max',
+        parallel_conv_weights='shared',
+        __definition__parallel_conv_weights='when parallel_conv is true, shared runs one convolutional tower over every detector, grouped gives each detector its own tower weights (grouped Conv1D, needs tensorflow >= 2.3)',
+        parallel_conv_features=256,
+        __definition__parallel_conv_features='with parallel_conv and the flatten trunk reduction, number of features each detector tower is projected onto before the towers are merged',
+        multirate_bands=[],
+        __definition__multirate_bands='list of [num_samples, decimation] pairs splitting the ndata whitened samples into time segments at decreasing sample rates before the network, e.g. [[512,8],[256,4],[128,2],[128,1]] for ndata 1024, empty for the native rate',
     )
     return params
 
@@ -0,0 +1,42 @@
+import numpy as np
+import tensorflow as tf
+
+def multirate_length(bands, ndata):
+    """Number of samples per detector after multirate, ndata when bands is empty.
+
+    bands is a list of [num_samples, decimation] pairs covering the ndata native samples in
+    time order, each num_samples must be a multiple of its decimation.
+    """
+    if not bands:
+        return ndata
+    if sum(n for n, _ in bands) != ndata:
+        raise ValueError('multirate_bands cover {} samples, expected ndata = {}'.format(sum(n for n, _ in bands), ndata))
+    for n, d in bands:
+        if n % d != 0:
+            raise ValueError('multirate band of {} samples is not a multiple of its decimation {}'.format(n, d))
+    return sum(n//d for n, d in bands)
+
+def multirate(y, bands):
+    """Decimate consecutive time segments of whitened strain y (num_templates, num_samples, num_dets).
+
+    Segment i holds bands[i][0] samples and is averaged over blocks of bands[i][1] samples,
+    the blocks are scaled by sqrt(decimation) so whitened noise keeps unit variance. The early
+    low frequency part of a chirp can use large decimations while the merger keeps the native
+    rate. Numpy input gives numpy output, anything else goes through tensorflow.
+    """
+    if not bands:
+        return y
+    numpy_input = isinstance(y, np.ndarray)
+    num_dets = y.shape[-1]
+    segments = []
+    start = 0
+    for n, d in bands:
+        segment = y[:,start:start + n]
+        if d > 1:
+            if numpy_input:
+                segment = float(np.sqrt(d))*np.mean(np.reshape(segment, (-1, n//d, d, num_dets)), axis=2)
+            else:
+                segment = float(np.sqrt(d))*tf.reduce_mean(tf.reshape(segment, (-1, n//d, d, num_dets)), axis=2)
+        segments.append(segment)
+        start += n
+    return np.concatenate(segments, axis=1) if numpy_input else tf.concat(segments, axis=1)
@@ -24,6 +24,7 @@ from matplotlib.ticker import (MultipleLocator, FormatStrFormatter, FixedLocator
 import matplotlib.ticker as ticker
 from lal import GreenwichMeanSiderealTime
 from load_data import load_samples, convert_hour_angle_to_ra
+from vitamin_c_model import in_prior_mask
 
 def prune_samples(chain_file_loc,params):
     """ Function to remove bad likelihood emcee chains 
@@ -420,13 +421,13 @@ class make_plots:
 
         if self.params['load_plot_data'] == False:
             pp = np.zeros(((self.params['r'])+2,len(self.params['bilby_pars']))) 
+            # generate Vitamin samples for all of the test cases together
+            # The trained inverse model weights can then be used to infer a probability density of solutions 
+            # given new measurements
+            vi_samples = model.gen_samples_batch(sig_test[:Npp], nsamples=params['n_samples'], in_bounds=params['in_bounds_sampling'])
             for cnt in range(Npp):
 
-                # generate Vitamin samples
-                y = np.expand_dims(sig_test[cnt,:], axis=0)
-                 # The trained inverse model weights can then be used to infer a probability density of solutions 
-#given new measurements
-                samples = np.array(model.gen_samples(y, ramp=1, nsamples=params['n_samples']))
+                samples = vi_samples[cnt]
                 
                 true_XS = np.zeros([samples.shape[0],len(inf_ol_idx)])
                 true_x = np.zeros([len(inf_ol_idx)])
@@ -440,28 +441,7 @@ class make_plots:
                     cnt_rm_inf += 1
 
                 # Apply mask
-                x = true_XS
-                x = x.T
-                sampset_1 = x   
-                del_cnt = 0
-                # iterate over each sample   during inference training
-                for i in range(sampset_1.shape[1]):
-                    # iterate over each parameter
-                    for k,q in enumerate(self.params['bilby_pars']):
-                        # if sample out of range, delete the sample                                              the y data (size changes by factor of  n_filter/(2**n_redsteps) )
-                        if sampset_1[k,i] < 0.0 or sampset_1[k,i] > 1.0:
-                            x = np.delete(x,del_cnt,axis=1)   
-                            del_cnt-=1
-                            break
-                        # check m1 > m2
-                        elif q == 'mass_1' or q == 'mass_2':
-                            m1_idx = np.argwhere(self.params['bilby_pars']=='mass_1')
-                            m2_idx = np.argwhere(self.params['bilby_pars']=='mass_2')
-                            if sampset_1[m1_idx,i] < sampset_1[m2_idx,i]:
-                                x = np.delete(x,del_cnt,axis=1)
-                                del_cnt-=1
-                                break    
-                    del_cnt+=1
+                x = true_XS[in_prior_mask(true_XS,ol_pars,bounds)].T
                 for j in range(len(self.params['bilby_pars'])):
                     pp[0,j] = 0.0
                     pp[1,j] = 1.0
@@ -510,12 +490,8 @@ class make_plots:
                     true_x[:,cnt_rm_inf] = par_test[:,inf_idx]
                     ol_pars.append(bilby_par)
                     cnt_rm_inf += 1
-                samples = true_XS
-
-                if samples.shape[0] == self.params['r']:
-                    samples = samples[:,:,-self.params['n_samples']:]
-                else:
-                    samples = samples[:self.params['n_samples'],:]
+                # load_samples returns exactly r test cases in test set order
+                samples = true_XS[:,-self.params['n_samples']:]
 
             for j in range(len(self.params['bilby_pars'])):
                 pp_bilby = np.zeros((self.params['r'])+2)
@@ -647,31 +623,6 @@ class make_plots:
                 true_XS[:,cnt_rm_inf] = samples[:,inf_idx] # (samples[:,inf_idx] * (bounds[inf_par+'_max'] - bounds[inf_par+'_min'])) + bounds[inf_par+'_min']
                 cnt_rm_inf += 1
 
-            # Apply mask
-            true_XS = true_XS.T
-            sampset_1 = true_XS
-            del_cnt = 0
-            # iterate over each sample   during inference training
-            for i in range(sampset_1.shape[1]):
-                # iterate over each parameter
-                for k,q in enumerate(self.params['bilby_pars']):
-                    # if sample out of range, delete the sample                                              the y data (size changes by factor of  n_filter/(2**n_redsteps) )
-                    if sampset_1[k,i] < 0.0 or sampset_1[k,i] > 1.0:
-                        true_XS = np.delete(true_XS,del_cnt,axis=1)
-                        del_cnt-=1
-                        break
-                    # check m1 > m2
-                    elif q == 'mass_1' or q == 'mass_2':
-                        m1_idx = np.argwhere(self.params['bilby_pars']=='mass_1')
-                        m2_idx = np.argwhere(self.params['bilby_pars']=='mass_2')
-                        if sampset_1[m1_idx,i] < sampset_1[m2_idx,i]:
-                            true_XS = np.delete(true_XS,del_cnt,axis=1)
-                            del_cnt-=1
-                            break
-            # transpose
-            true_XS = np.zeros([samples.shape[0],len(inf_ol_idx)])
-            for i in range(true_XS.shape[1]):
-                true_XS[:,i] = sampset_1[i,:]
             return true_XS
 
         def compute_kl(sampset_1,sampset_2,samplers,one_D=False):
@@ -685,58 +636,12 @@ class make_plots:
             # Iterate over parameters and remove samples outside of prior
             if samplers[0] == 'vitamin1' or samplers[1] == 'vitamin2':
 
-                # Apply mask
-                sampset_1 = sampset_1.T
-                sampset_2 = sampset_2.T
-                set1 = sampset_1
-                set2 = sampset_2
-                del_cnt_set1 = 0
-                del_cnt_set2 = 0
-                params_to_infer = self.params['inf_pars']
-                for i in range(set1.shape[1]):
-
-                    # iterate over each parameter in first set
-                    for k,q in enumerate(params_to_infer):
-                        # if sample out of range, delete the sample
-                        if set1[k,i] < 0.0 or set1[k,i] > 1.0:
-                            sampset_1 = np.delete(sampset_1,del_cnt_set1,axis=1)
-                            del_cnt_set1-=1
-                            break
-                        # check m1 > m2
-                        elif q == 'mass_1' or q == 'mass_2':
-                            m1_idx = np.argwhere(params_to_infer=='mass_1')
-                            m2_idx = np.argwhere(params_to_infer=='mass_2')
-                            if set1[m1_idx,i] < set1[m2_idx,i]:
-                                sampset_1 = np.delete(sampset_1,del_cnt_set1,axis=1)
-                                del_cnt_set1-=1
-                                break
-
-                    del_cnt_set1+=1
-
-                # iterate over each sample
-                for i in range(set2.shape[1]):
-
-                    # iterate over each parameter in second set
-                    for k,q in enumerate(params_to_infer):
-                        # if sample out of range, delete the sample
-                        if set2[k,i] < 0.0 or set2[k,i] > 1.0:
-                            sampset_2 = np.delete(sampset_2,del_cnt_set2,axis=1)
-                            del_cnt_set2-=1
-                            break
-                        # check m1 > m2
-                        elif q == 'mass_1' or q == 'mass_2':
-                            m1_idx = np.argwhere(params_to_infer=='mass_1')
-                            m2_idx = np.argwhere(params_to_infer=='mass_2')
-                            if set2[m1_idx,i] < set2[m2_idx,i]:
-                                sampset_2 = np.delete(sampset_2,del_cnt_set2,axis=1)
-                                del_cnt_set2-=1
-                                break
-
-                    del_cnt_set2+=1
-
-                del_final_idx = np.min([del_cnt_set1,del_cnt_set2])
-                set1 = sampset_1[:,:del_final_idx]
-                set2 = sampset_2[:,:del_final_idx]
+                # Apply mask and keep the same number of samples from both sets
+                set1 = sampset_1[in_prior_mask(sampset_1,self.params['inf_pars'],bounds)]
+                set2 = sampset_2[in_prior_mask(sampset_2,self.params['inf_pars'],bounds)]
+                del_final_idx = np.min([set1.shape[0],set2.shape[0]])
+                set1 = set1[:del_final_idx].T
+                set2 = set2[:del_final_idx].T
 
             else:
 
@@ -874,17 +779,17 @@ class make_plots:
                                 set1 = load_samples(params, sampler1, pp_plot=True)
                             elif sampler1 == 'vitamin' and vi_pred_made == None:
                                 set1 = np.zeros((params['r'], params['n_samples'], len(params['bilby_pars'])))
+                                vi_samples = model.gen_samples_batch(sig_test[:params['r']], nsamples=params['n_samples'], in_bounds=params['in_bounds_sampling'])
                                 for sig_test_idx in range(params['r']):
-                                    samples = np.array(model.gen_samples(np.expand_dims(sig_test[sig_test_idx], axis=0), ramp=1, nsamples=params['n_samples'])) 
-                                    set1[sig_test_idx,:,:] = extract_correct_sample_idx(samples, inf_ol_idx)
+                                    set1[sig_test_idx,:,:] = extract_correct_sample_idx(vi_samples[sig_test_idx], inf_ol_idx)
                                 vi_pred_made = [set1]
                             if sampler2 != 'vitamin':
                                 set2 = load_samples(params, sampler2, pp_plot=True)
                             elif sampler1 == 'vitamin' and vi_pred_made == None:
                                 set2 = np.zeros((params['r'], params['n_samples'], len(params['bilby_pars'])))
+                                vi_samples = model.gen_samples_batch(sig_test[:params['r']], nsamples=params['n_samples'], in_bounds=params['in_bounds_sampling'])
                                 for sig_test_idx in range(params['r']):
-                                    samples = np.array(model.gen_samples(np.expand_dims(sig_test[sig_test_idx], axis=0), ramp=1, nsamples=params['n_samples']))
-                                    set2[sig_test_idx,:,:] = extract_correct_sample_idx(samples, inf_ol_idx)
+                                    set2[sig_test_idx,:,:] = extract_correct_sample_idx(vi_samples[sig_test_idx], inf_ol_idx)
                                 vi_pred_made = [set2]
 
                         # Iterate over test cases
@@ -47,11 +47,13 @@ try:
     from . import plotting
     from . import vitamin_c_new as vitamin_c
     from .plotting import prune_samples
+    from .load_data import convert_to_shards
 except (ModuleNotFoundError, ImportError):
     from gen_benchmark_pe import run, gen_real_noise
     import plotting
     import vitamin_c_new as vitamin_c
     from plotting import prune_samples
+    from load_data import convert_to_shards
 
 # Check for optional basemap installation
 try:
@@ -81,6 +83,7 @@ parser = argparse.ArgumentParser(description='VItamin: A user friendly Bayesian
 parser.add_argument("--gen_train", default=False, help="generate the training data")
 parser.add_argument("--gen_rnoise", default=False, help="generate the real noise samples")
 parser.add_argument("--gen_val", default=False, help="generate the validation data")
+parser.add_argument("--pack_train", default=False, help="pack the training data into a few large indexed shards")
 parser.add_argument("--gen_test", default=False, help="generate the testing data")
 parser.add_argument("--train", default=False, help="train the network")
 parser.add_argument("--resume_training", default=False, help="resume training of network")
@@ -554,19 +557,21 @@ def gen_train(params=params,bounds=bounds,fixed_vals=fixed_vals):
         })
         with suppress_stdout():
             # generate training sample source parameter, waveform and snr
-            signal_train, signal_train_pars,snrs = run(sampling_frequency=params['ndata']/params['duration'],
-                                                          duration=params['duration'],
-                                                          N_gen=params['tset_split'],
-                                                          ref_geocent_time=params['ref_geocent_time'],
-                                                          bounds=bounds,
-                                                          fixed_vals=fixed_vals,
-                                                          rand_pars=params['rand_pars'],
-                                                          seed=params['training_data_seed']+i,
-                                                          label=params['run_label'],
-                                                          training=True,det=params['det'],
-                                                          psd_files=params['psd_files'],
-                                                          use_real_det_noise=params['use_real_det_noise'],
-                                                          samp_idx=i, params=params)
+            train_set = run(sampling_frequency=params['ndata']/params['duration'],
+                            duration=params['duration'],
+                            N_gen=params['tset_split'],
+                            ref_geocent_time=params['ref_geocent_time'],
+                            bounds=bounds,
+                            fixed_vals=fixed_vals,
+                            rand_pars=params['rand_pars'],
+                            seed=params['training_data_seed']+i,
+                            label=params['run_label'],
+                            training=True,det=params['det'],
+                            psd_files=params['psd_files'],
+                            use_real_det_noise=params['use_real_det_noise'],
+                            samp_idx=i, params=params,
+                            store_polarisations=params['store_polarisations'])
+            signal_train, signal_train_pars, snrs = train_set[:3]
         logging.config.dictConfig({
         'version': 1,
         'disable_existing_loggers': False,
@@ -587,9 +592,41 @@ def gen_train(params=params,bounds=bounds,fixed_vals=fixed_vals):
         hf.create_dataset('y_data_noisy', data=np.array([]))
         hf.create_dataset('y_data_noisefree', data=signal_train)
         hf.create_dataset('snrs', data=snrs)
+        if params['store_polarisations']:
+            # unprojected polarisations and detector information for extrinsic parameter augmentation
+            hf.create_dataset('y_data_polarisations', data=train_set[3])
+            for k, v in train_set[4].items():
+                hf.create_dataset(k, data=v)
         hf.close()
     return
 
+def pack_train(params=params):
+    """ Pack the training set into a few large shards
+
+    The packed data is written to <train_set_dir>_packed. Set train_set_dir to
+    this directory to train from the shards.
+
+    Parameters
+    ----------
+    params: dict
+        Dictionary containing run parameters
+    """
+
+    # Check for requried parameters files
+    if params == None:
+        print('Missing params file')
+        exit()
+
+    # Load parameters files
+    with open(params, 'r') as fp:
+        params = json.load(fp)
+
+    output_dir = params['train_set_dir'].rstrip('/') + '_packed'
+    print('... Packing training set into %s' % output_dir)
+    num_data = convert_to_shards(params['train_set_dir'], output_dir, samples_per_shard=params['samples_per_shard'], channels_last=params['pack_channels_last'], freq_domain=params['pack_freq_domain'])
+    print('... Packed %d training samples' % num_data)
+    return
+
 def gen_val(params=params,bounds=bounds,fixed_vals=fixed_vals):
     """ Generate validation samples
 
@@ -1517,6 +1554,8 @@ if args.gen_rnoise:
     gen_rnoise(params,bounds,fixed_vals)
 if args.gen_val:
     gen_val(params,bounds,fixed_vals)
+if args.pack_train:
+    pack_train(params)
 if args.gen_test:
     gen_test(params,bounds,fixed_vals)
 if args.train:
@@ -3,6 +3,47 @@ from tensorflow.keras import regularizers
 import tensorflow_probability as tfp
 tfd = tfp.distributions
 import numpy as np
+import time
+from functools import lru_cache
+from multirate import multirate_length
+from log_density import diag_gaussian_entropy, gaussian_mixture_log_prob, recon_log_prob, sample_von_mises
+
+def apply_layers(layers, x):
+    """Apply a list of layers in sequence."""
+    for layer in layers:
+        x = layer(x)
+    return x
+
+def in_prior_mask(x, pars, bounds):
+    """Boolean mask over the leading axes of the normalised samples x with columns pars, true for
+    samples inside the prior cube whose mass_1 >= mass_2 once denormalised with bounds."""
+    pars = list(pars)
+    valid = np.all((x >= 0.0) & (x <= 1.0), axis=-1)
+    if 'mass_1' in pars and 'mass_2' in pars:
+        m1 = bounds['mass_1_min'] + x[...,pars.index('mass_1')]*(bounds['mass_1_max'] - bounds['mass_1_min'])
+        m2 = bounds['mass_2_min'] + x[...,pars.index('mass_2')]*(bounds['mass_2_max'] - bounds['mass_2_min'])
+        valid &= m1 >= m2
+    return valid
+
+@lru_cache(maxsize=None)
+def grouped_conv_supported():
+    """Whether Conv1D groups run on the default device, older tensorflow has no grouped convolutions on CPU."""
+    try:
+        tf.keras.layers.Conv1D(filters=2, kernel_size=1, groups=2)(tf.zeros([1,1,2]))
+        return True
+    except (TypeError, ValueError, tf.errors.OpError):
+        return False
+
+class DetectorTowers(tf.keras.layers.Layer):
+    """Apply a separate list of layers to each detector channel and concatenate the outputs detector major,
+    the same layout as a grouped convolution with one group per detector."""
+
+    def __init__(self, towers, **kwargs):
+        super(DetectorTowers, self).__init__(**kwargs)
+        self.towers = towers
+
+    def call(self, y):
+        return tf.concat([apply_layers(tower, y[...,i:i + 1]) for i, tower in enumerate(self.towers)], axis=-1)
 
 class CVAE(tf.keras.Model):
     """Convolutional variational autoencoder."""
@@ -13,7 +54,8 @@ class CVAE(tf.keras.Model):
         self.n_modes = n_modes
         self.x_modes = 1   # hardcoded for testing
         self.x_dim = x_dim
-        self.y_dim = y_dim
+        # the network sees the decimated strain when multirate bands are set
+        self.y_dim = multirate_length(params['multirate_bands'], y_dim)
         self.n_channels = n_channels
         self.act = tf.keras.layers.LeakyReLU(alpha=0.3)
         self.params = params
@@ -28,59 +70,167 @@ class CVAE(tf.keras.Model):
         self.encoder_r1 = tf.keras.Model(inputs=r1_input_y, outputs=a2)
         print(self.encoder_r1.summary())
         """
-        # the r1 encoder network
+        # the shared convolutional trunk
         r1_input_y = tf.keras.Input(shape=(self.y_dim, self.n_channels))
-        a = tf.keras.layers.Conv1D(filters=32, kernel_size=11, strides=1, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(r1_input_y)
-        a = tf.keras.layers.Conv1D(filters=32, kernel_size=8, strides=2, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(a)
-        a = tf.keras.layers.Conv1D(filters=32, kernel_size=5, strides=1, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(a)
-        #a = tf.keras.layers.Conv1D(filters=96, kernel_size=16, strides=2, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(a)
-        #a = tf.keras.layers.Conv1D(filters=96, kernel_size=16, strides=1, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(a)
-        #a = tf.keras.layers.Conv1D(filters=96, kernel_size=16, strides=2, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(a)
-        a = tf.keras.layers.Flatten()(a)
-        a2 = tf.keras.layers.Dense(4096, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(a)
-        a2 = tf.keras.layers.Dropout(.5)(a2)
-        a2 = tf.keras.layers.Dense(2048, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(a2)
-        a2 = tf.keras.layers.Dropout(.5)(a2)
-        a2 = tf.keras.layers.Dense(1024, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(a2)
-        a2 = tf.keras.layers.Dense(2*self.z_dim*self.n_modes + self.n_modes)(a2)
-        self.encoder_r1 = tf.keras.Model(inputs=r1_input_y, outputs=a2)
+        a = apply_layers(self.trunk_layers(), r1_input_y)
+        # input to the heads when the trunk has already been evaluated
+        features = tf.keras.Input(shape=a.shape[1:])
+
+        # the r1 encoder network
+        r1_layers = [tf.keras.layers.Dense(4096, kernel_regularizer=regularizers.l2(0.001), activation=self.act),
+                     tf.keras.layers.Dropout(.5),
+                     tf.keras.layers.Dense(2048, kernel_regularizer=regularizers.l2(0.001), activation=self.act),
+                     tf.keras.layers.Dropout(.5),
+                     tf.keras.layers.Dense(1024, kernel_regularizer=regularizers.l2(0.001), activation=self.act),
+                     tf.keras.layers.Dense(2*self.z_dim*self.n_modes + self.n_modes)]
+        self.encoder_r1 = tf.keras.Model(inputs=r1_input_y, outputs=apply_layers(r1_layers, a))
         print(self.encoder_r1.summary())
 
         # the q encoder network
         q_input_x = tf.keras.Input(shape=(self.x_dim))
-        c = tf.keras.layers.Flatten()(q_input_x)
-        d = tf.keras.layers.concatenate([a,c])        
-        e = tf.keras.layers.Dense(4096, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(d)
-        e = tf.keras.layers.Dropout(.5)(e)
-        e = tf.keras.layers.Dense(2048, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(e)
-        e = tf.keras.layers.Dropout(.5)(e)
-        e = tf.keras.layers.Dense(1024, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(e)
-        e = tf.keras.layers.Dense(2*self.z_dim)(e)
-        self.encoder_q = tf.keras.Model(inputs=[r1_input_y, q_input_x], outputs=e)
+        q_flatten = tf.keras.layers.Flatten()
+        q_concat = tf.keras.layers.Concatenate()
+        q_layers = [tf.keras.layers.Dense(4096, kernel_regularizer=regularizers.l2(0.001), activation=self.act),
+                    tf.keras.layers.Dropout(.5),
+                    tf.keras.layers.Dense(2048, kernel_regularizer=regularizers.l2(0.001), activation=self.act),
+                    tf.keras.layers.Dropout(.5),
+                    tf.keras.layers.Dense(1024, kernel_regularizer=regularizers.l2(0.001), activation=self.act),
+                    tf.keras.layers.Dense(2*self.z_dim)]
+        self.encoder_q = tf.keras.Model(inputs=[r1_input_y, q_input_x], outputs=apply_layers(q_layers, q_concat([a,q_flatten(q_input_x)])))
         print(self.encoder_q.summary())
 
         # the r2 decoder network
         r2_input_z = tf.keras.Input(shape=(self.z_dim))
-        g = tf.keras.layers.Flatten()(r2_input_z)
-        h = tf.keras.layers.concatenate([a,g])
-        i = tf.keras.layers.Dense(4096, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(h)
-        i = tf.keras.layers.Dropout(.5)(i)
-        i = tf.keras.layers.Dense(2048, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(i)
-        i = tf.keras.layers.Dropout(.5)(i)
-        i = tf.keras.layers.Dense(1024, kernel_regularizer=regularizers.l2(0.001), activation=self.act)(i)
-        j = tf.keras.layers.Dense(2*self.x_dim*self.x_modes + self.x_modes)(i)
-        self.decoder_r2 = tf.keras.Model(inputs=[r1_input_y, r2_input_z], outputs=j)
+        r2_flatten = tf.keras.layers.Flatten()
+        r2_concat = tf.keras.layers.Concatenate()
+        r2_layers = [tf.keras.layers.Dense(4096, kernel_regularizer=regularizers.l2(0.001), activation=self.act),
+                     tf.keras.layers.Dropout(.5),
+                     tf.keras.layers.Dense(2048, kernel_regularizer=regularizers.l2(0.001), activation=self.act),
+                     tf.keras.layers.Dropout(.5),
+                     tf.keras.layers.Dense(1024, kernel_regularizer=regularizers.l2(0.001), activation=self.act),
+                     tf.keras.layers.Dense(2*self.x_dim*self.x_modes + self.x_modes)]
+        self.decoder_r2 = tf.keras.Model(inputs=[r1_input_y, r2_input_z], outputs=apply_layers(r2_layers, r2_concat([a,r2_flatten(r2_input_z)])))
         print(self.decoder_r2.summary())
 
-    def encode_r1(self, y=None):
-        mean, logvar, weight = tf.split(self.encoder_r1(y), num_or_size_splits=[self.z_dim*self.n_modes, self.z_dim*self.n_modes,self.n_modes], axis=1)
+        # the trunk and the three heads as separate models sharing the layers above, so the trunk is evaluated
+        # once per step. The full models are kept so that checkpoints are unchanged
+        self.trunk = tf.keras.Model(inputs=r1_input_y, outputs=a)
+        self.head_r1 = tf.keras.Model(inputs=features, outputs=apply_layers(r1_layers, features))
+        self.head_q = tf.keras.Model(inputs=[features, q_input_x], outputs=apply_layers(q_layers, q_concat([features,q_flatten(q_input_x)])))
+        self.head_r2 = tf.keras.Model(inputs=[features, r2_input_z], outputs=apply_layers(r2_layers, r2_concat([features,r2_flatten(r2_input_z)])))
+        # kept so that sampling can split the first r2 layer into a per event and a per sample part
+        self.r2_layers = r2_layers
+        # compiled sampler used for batches of events, retraced only for new chunk sizes
+        self.sample_event_graph = tf.function(self.sample_event)
+        self.reset_acceptance()
+
+    def trunk_layers(self):
+        """Layers of the shared convolutional trunk.
+
+        With params['conv_trunk'] 'default' this is the original three layer trunk. With 'params'
+        layer i is a Conv1D with n_filters_r1[i], filter_size_r1[i], conv_strides_r1[i] and
+        conv_dilations_r1[i], followed by max pooling of size maxpool_r1[i] and stride
+        pool_strides_r1[i] when the size is above 1. params['trunk_pooling'] then reduces the
+        last feature map, 'flatten' keeps every position while 'global_average' and
+        'global_max' keep one value per filter.
+
+        With params['parallel_conv'] every detector goes through its own tower and the towers
+        are merged after the reduction. params['parallel_conv_weights'] 'shared' applies one
+        tower to each detector in turn, 'grouped' gives each detector its own weights through
+        grouped convolutions. With the flatten reduction each tower is then projected onto
+        params['parallel_conv_features'] values before the merge, so the trunk output grows by
+        that many features per detector rather than by a whole flattened feature map. Where
+        grouped convolutions are not supported the grouped weights are built as separate
+        towers per detector instead, with the same output layout.
+        """
+        if self.params['conv_trunk'] == 'default':
+            specs = [(32,11,1,1,1,1), (32,8,2,1,1,1), (32,5,1,1,1,1)]
+            padding, reduction = 'valid', 'flatten'
+        elif self.params['conv_trunk'] == 'params':
+            specs = list(zip(self.params['n_filters_r1'], self.params['filter_size_r1'],
+                             self.params['conv_strides_r1'], self.params['conv_dilations_r1'],
+                             self.params['maxpool_r1'], self.params['pool_strides_r1']))
+            padding, reduction = 'same', self.params['trunk_pooling']
+        else:
+            raise ValueError('conv_trunk must be default or params, got {}'.format(self.params['conv_trunk']))
+
+        pooling = dict(flatten=tf.keras.layers.Flatten,
+                       global_average=tf.keras.layers.GlobalAveragePooling1D,
+                       global_max=tf.keras.layers.GlobalMaxPooling1D)
+        if reduction not in pooling:
+            raise ValueError('trunk_pooling must be one of {}, got {}'.format(', '.join(pooling), reduction))
+        weights = self.params['parallel_conv_weights'] if self.params['parallel_conv'] else 'dense'
+        if weights not in ('dense', 'shared', 'grouped'):
+            raise ValueError('parallel_conv_weights must be shared or grouped, got {}'.format(weights))
+        groups = self.n_channels if weights == 'grouped' else 1
+        project = weights != 'dense' and reduction == 'flatten'
+        n_project = self.params['parallel_conv_features'] if project else 0
+
+        def conv_layers(groups):
+            layers = []
+            for filters, size, stride, dilation, pool, pool_stride in specs:
+                if stride > 1 and dilation > 1:
+                    raise ValueError('a trunk layer cannot have both a stride and a dilation above 1')
+                conv_args = dict(filters=filters*groups, kernel_size=size, strides=stride, dilation_rate=dilation, padding=padding,
+                                 kernel_regularizer=regularizers.l2(0.001), activation=self.act)
+                if groups > 1:
+                    conv_args['groups'] = groups
+                layers.append(tf.keras.layers.Conv1D(**conv_args))
+                if pool > 1:
+                    layers.append(tf.keras.layers.MaxPooling1D(pool_size=pool, strides=pool_stride, padding=padding))
+            return layers
+
+        if groups > 1 and not grouped_conv_supported():
+            print('Grouped convolutions are not supported here, building a separate conv tower per detector')
+            towers = []
+            for _ in range(self.n_channels):
+                tower = conv_layers(1) + [pooling[reduction]()]
+                if project:
+                    tower.append(tf.keras.layers.Dense(n_project, kernel_regularizer=regularizers.l2(0.001), activation=self.act))
+                towers.append(tower)
+            return [DetectorTowers(towers)]
+
+        layers = conv_layers(groups)
+        filters = specs[-1][0]
+        if weights == 'shared':
+            # detectors become a time axis so the same tower runs on each, then the outputs are joined
+            layers.append(pooling[reduction]())
+            if project:
+                layers.append(tf.keras.layers.Dense(n_project, kernel_regularizer=regularizers.l2(0.001), activation=self.act))
+            layers = [tf.keras.layers.Permute((2,1)), tf.keras.layers.Reshape((self.n_channels, self.y_dim, 1))] + \
+                     [tf.keras.layers.TimeDistributed(layer) for layer in layers] + [tf.keras.layers.Flatten()]
+        elif project:
+            # regroup the channels detector major into a single position, then a grouped conv of
+            # kernel size 1 is a separate dense projection of each detector's feature map
+            layers += [tf.keras.layers.Reshape((-1, self.n_channels, filters)),
+                       tf.keras.layers.Permute((2,1,3)),
+                       tf.keras.layers.Reshape((1, -1)),
+                       tf.keras.layers.Conv1D(filters=n_project*groups, kernel_size=1, groups=groups,
+                                              kernel_regularizer=regularizers.l2(0.001), activation=self.act),
+                       tf.keras.layers.Flatten()]
+        else:
+            layers.append(pooling[reduction]())
+        return layers
+
+    def embed(self, y):
+        """Evaluate the shared convolutional trunk on y."""
+        return self.trunk(y)
+
+    def encode_r1(self, y=None, features=None):
+        if features is None:
+            features = self.embed(y)
+        mean, logvar, weight = tf.split(self.head_r1(features), num_or_size_splits=[self.z_dim*self.n_modes, self.z_dim*self.n_modes,self.n_modes], axis=1)
         return tf.reshape(mean,[-1,self.n_modes,self.z_dim]), tf.reshape(logvar,[-1,self.n_modes,self.z_dim]), tf.reshape(weight,[-1,self.n_modes])
 
-    def encode_q(self, x=None, y=None):
-        return tf.split(self.encoder_q([y,x]), num_or_size_splits=[self.z_dim,self.z_dim], axis=1)
+    def encode_q(self, x=None, y=None, features=None):
+        if features is None:
+            features = self.embed(y)
+        return tf.split(self.head_q([features,x]), num_or_size_splits=[self.z_dim,self.z_dim], axis=1)
 
-    def decode_r2(self, y=None, z=None, apply_sigmoid=False):
-        mean, logvar, weight = tf.split(self.decoder_r2([y,z]), num_or_size_splits=[self.x_dim*self.x_modes, self.x_dim*self.x_modes,self.x_modes], axis=1)
+    def decode_r2(self, y=None, z=None, apply_sigmoid=False, features=None):
+        if features is None:
+            features = self.embed(y)
+        mean, logvar, weight = tf.split(self.head_r2([features,z]), num_or_size_splits=[self.x_dim*self.x_modes, self.x_dim*self.x_modes,self.x_modes], axis=1)
         return tf.reshape(mean,[-1,self.x_modes,self.x_dim]), tf.reshape(logvar,[-1,self.x_modes,self.x_dim]), tf.reshape(weight,[-1,self.x_modes])
 
     @tf.function
@@ -107,21 +257,16 @@ class CVAE(tf.keras.Model):
         y = tf.cast(y, dtype=tf.float32)
         x = tf.cast(x, dtype=tf.float32)
         
-        mean_r1, logvar_r1, logweight_r1 = self.encode_r1(y=y)
+        # the convolutional trunk is shared by all three networks, evaluate it once
+        features = self.embed(y)
+
+        mean_r1, logvar_r1, logweight_r1 = self.encode_r1(features=features)
         scale_r1 = self.EPS + tf.sqrt(tf.exp(logvar_r1))
-        gm_r1 = tfd.MixtureSameFamily(mixture_distribution=tfd.Categorical(logits=logweight_r1),
-                                      components_distribution=tfd.MultivariateNormalDiag(
-                                          loc=mean_r1,
-                                          scale_diag=scale_r1))
 
-        mean_q, logvar_q = self.encode_q(x=x,y=y)
+        mean_q, logvar_q = self.encode_q(x=x,features=features)
         scale_q = self.EPS + tf.sqrt(tf.exp(logvar_q))
-        mvn_q = tfp.distributions.MultivariateNormalDiag(
-            loc=mean_q,
-            scale_diag=scale_q)
-        #mvn_q = tfd.Normal(loc=mean_q,scale=scale_q)
-        z_samp = mvn_q.sample()
-        mean_r2, logvar_r2, logweight_r2 = self.decode_r2(z=z_samp,y=y)
+        z_samp = mean_q + scale_q*tf.random.normal(tf.shape(mean_q))
+        mean_r2, logvar_r2, logweight_r2 = self.decode_r2(z=z_samp,features=features)
         scale_r2 = self.EPS + tf.sqrt(tf.exp(logvar_r2))
         
 
@@ -135,17 +280,9 @@ class CVAE(tf.keras.Model):
 
         tmvn_r2_cost_recon = -1.0*tf.reduce_mean(tf.reduce_sum(tmvn_r2.log_prob(tf.boolean_mask(x,self.masks["nonperiodic_mask"],axis=1)),axis=1),axis=0)
         """
-        tmvn_r2 = tfd.MultivariateNormalDiag(
-            loc=tf.boolean_mask(tf.squeeze(mean_r2),self.masks["nonperiodic_mask"],axis=1),
-            scale_diag=tf.boolean_mask(tf.squeeze(scale_r2),self.masks["nonperiodic_mask"],axis=1))
-        tmvn_r2_cost_recon = -1.0*tf.reduce_mean(tmvn_r2.log_prob(tf.boolean_mask(tf.squeeze(x),self.masks["nonperiodic_mask"],axis=1)))
-
-        vm_r2 = tfp.distributions.VonMises(
-            loc=2.0*np.pi*tf.boolean_mask(tf.squeeze(mean_r2),self.masks["periodic_mask"],axis=1),
-            concentration=tf.math.reciprocal(tf.math.square(tf.boolean_mask(tf.squeeze(2.0*np.pi*scale_r2),self.masks["periodic_mask"],axis=1)))
-        )
-        vm_r2_cost_recon = -1.0*tf.reduce_mean(tf.reduce_sum(tf.math.log(2.0*np.pi) + vm_r2.log_prob(2.0*np.pi*tf.boolean_mask(x,self.masks["periodic_mask"],axis=1)),axis=1),axis=0)
-        simple_cost_recon = tmvn_r2_cost_recon + vm_r2_cost_recon
+        # closed form Gaussian and von Mises terms with static gather indices, see log_density.compare_with_tfp
+        # the single x mode is dropped so every event is scored against its own r2 output only
+        simple_cost_recon = -1.0*tf.reduce_mean(recon_log_prob(x, mean_r2[:,0,:], scale_r2[:,0,:], self.masks["nonperiodic_idx_mask"], self.masks["periodic_idx_mask"]))
         #print("cost", tmvn_r2_cost_recon , vm_r2_cost_recon)
         #if np.isnan(simple_cost_recon):
         #    print(tmvn_r2_cost_recon, vm_r2_cost_recon)
@@ -163,72 +300,280 @@ class CVAE(tf.keras.Model):
 
 
         
-        selfent_q = -1.0*tf.reduce_mean(mvn_q.entropy())
-        log_r1_q = gm_r1.log_prob(z_samp)   # evaluate the log prob of r1 at the q samples
+        selfent_q = -1.0*tf.reduce_mean(diag_gaussian_entropy(scale_q))
+        log_r1_q = gaussian_mixture_log_prob(z_samp, mean_r1, scale_r1, logweight_r1)   # evaluate the log prob of r1 at the q samples
         cost_KL = selfent_q - tf.reduce_mean(log_r1_q)
         return simple_cost_recon, cost_KL
         
-    def gen_samples(self, y, ramp=1.0, nsamples=1000, max_samples=1000):
-        
-        y = y/self.params['y_normscale']
-        y = tf.tile(y,(max_samples,1,1))
-        samp_iterations = int(nsamples/max_samples)
-        for i in range(samp_iterations):
-            mean_r1, logvar_r1, logweight_r1 = self.encode_r1(y=y)
-            scale_r1 = self.EPS + tf.sqrt(tf.exp(logvar_r1))
-            gm_r1 = tfd.MixtureSameFamily(mixture_distribution=tfd.Categorical(logits=logweight_r1),
-                                          components_distribution=tfd.MultivariateNormalDiag(
-                                              loc=mean_r1,
-                                              scale_diag=scale_r1))
-            z_samp = gm_r1.sample()
-
-            mean_r2, logvar_r2, logweight_r2 = self.decode_r2(z=z_samp,y=y)
-            scale_r2 = self.EPS + tf.sqrt(tf.exp(logvar_r2))
-
-            tmvn_r2 = tfd.MultivariateNormalDiag(
-                loc=tf.boolean_mask(tf.squeeze(mean_r2),self.masks["nonperiodic_mask"],axis=1),
-                scale_diag=tf.boolean_mask(tf.squeeze(scale_r2),self.masks["nonperiodic_mask"],axis=1))
-            
-            vm_r2 = tfp.distributions.VonMises(
-                loc=2.0*np.pi*tf.boolean_mask(tf.squeeze(mean_r2),self.masks["periodic_mask"],axis=1),
-                concentration=tf.math.reciprocal(tf.math.square(tf.boolean_mask(tf.squeeze(2.0*np.pi*scale_r2),self.masks["periodic_mask"],axis=1)))
-            )
-            """
-            gm_r2 = tfd.MixtureSameFamily(mixture_distribution=tfd.Categorical(logits=logweight_r2),
-                                          components_distribution=tfd.MultivariateNormalDiag(
-                                              loc=mean_r2,
-                                             scale_diag=scale_r2))
-            """
-
-            if i==0:
-                #x_sample = gm_r2.sample()
-                tmvn_x_sample = tmvn_r2.sample()
-                vm_x_sample = tf.math.floormod(vm_r2.sample(),(2.0*np.pi))/(2.0*np.pi)
-                x_sample = tf.gather(tf.concat([tmvn_r2.sample(),vm_x_sample],axis=1),self.masks["idx_periodic_mask"],axis=1)
+    def embed_event(self, y):
+        """Per event quantities shared by every posterior sample of the events in y.
+
+        Holds the trunk features, the r1 mixture parameters and the feature part of the
+        first r2 layer. Passing the result back to gen_samples draws more samples for the
+        same events at the cost of the decoder only.
+        """
+        y = tf.cast(y, dtype=tf.float32)/self.params['y_normscale']
+        features = self.embed(y)
+        mean_r1, logvar_r1, logweight_r1 = self.encode_r1(features=features)
+        first = self.r2_layers[0]
+        n_features = features.shape[1]
+        return dict(features=features,
+                    mean_r1=mean_r1,
+                    scale_r1=self.EPS + tf.sqrt(tf.exp(logvar_r1)),
+                    logweight_r1=logweight_r1,
+                    r2_features=tf.matmul(features, first.kernel[:n_features]) + first.bias)
+
+    def r1_mixture(self, event):
+        """The r1 latent mixture of the events embedded by embed_event."""
+        return tfd.MixtureSameFamily(mixture_distribution=tfd.Categorical(logits=event['logweight_r1']),
+                                     components_distribution=tfd.MultivariateNormalDiag(
+                                         loc=event['mean_r1'],
+                                         scale_diag=event['scale_r1']))
+
+    def latent_uniforms(self, nsamples, n_events, latent_sampling):
+        """Uniforms of shape (nsamples, n_events, z_dim + 1) driving the r1 latent draws.
+
+        'sobol' gives a Sobol sequence with an independent random digital shift per event
+        and call, which keeps the points a net while making the estimates unbiased.
+        """
+        dim = self.z_dim + 1
+        # 23 bits keeps (k + 0.5)/2**bits exact in float32, at 24 the top cell rounds up to 1
+        bits = 23
+        if latent_sampling == 'sobol':
+            points = tf.cast(tf.floor(tf.math.sobol_sample(dim, nsamples, dtype=tf.float64)*2**bits), tf.int32)
+            shift = tf.random.uniform([n_events, dim], maxval=2**bits, dtype=tf.int32)
+            points = tf.bitwise.bitwise_xor(points[:,None,:], shift[None])
+        else:
+            points = tf.random.uniform([nsamples, n_events, dim], maxval=2**bits, dtype=tf.int32)
+        # cell centres, so neither 0 nor 1 reaches the normal quantile
+        return (tf.cast(points, tf.float32) + 0.5)/2**bits
+
+    def sample_latent(self, event, nsamples, latent_sampling=None, antithetic=None):
+        """Draw nsamples r1 latent samples per embedded event, returns (nsamples, n_events, z_dim).
+
+        latent_sampling is 'iid' or 'sobol' and defaults to params['latent_sampling']. The first
+        uniform picks the mixture component through the cumulative weights and the rest are
+        pushed through the normal quantile. With antithetic every second draw is the first
+        one mirrored about its component mean.
+        """
+        if latent_sampling is None:
+            latent_sampling = self.params['latent_sampling']
+        if antithetic is None:
+            antithetic = self.params['antithetic_latent']
+        if latent_sampling == 'iid' and not antithetic:
+            return self.r1_mixture(event).sample(nsamples)
+
+        n_events = tf.shape(event['mean_r1'])[0]
+        u = self.latent_uniforms((nsamples + 1)//2 if antithetic else nsamples, n_events, latent_sampling)
+        if antithetic:
+            u = tf.concat([u, tf.concat([u[...,:1], 1.0 - u[...,1:]], axis=-1)], axis=0)[:nsamples]
+        cdf = tf.math.cumsum(tf.nn.softmax(event['logweight_r1'], axis=-1), axis=-1)
+        mode = tf.reduce_sum(tf.cast(u[...,:1] > cdf[None], tf.int32), axis=-1)
+        mode = tf.transpose(tf.minimum(mode, self.n_modes - 1))
+        mean = tf.transpose(tf.gather(event['mean_r1'], mode, batch_dims=1), [1,0,2])
+        scale = tf.transpose(tf.gather(event['scale_r1'], mode, batch_dims=1), [1,0,2])
+        return mean + scale*tfd.Normal(loc=0.0, scale=1.0).quantile(u[...,1:])
+
+    def sample_event(self, event, nsamples, latent_sampling=None, antithetic=None, von_mises_sampler=None):
+        """Draw nsamples posterior samples for each embedded event, returns (nsamples, n_events, x_dim).
+
+        von_mises_sampler is 'tfp' or 'best_fisher' and defaults to params['von_mises_sampler'].
+        """
+        if von_mises_sampler is None:
+            von_mises_sampler = self.params['von_mises_sampler']
+        z_samp = self.sample_latent(event, nsamples, latent_sampling=latent_sampling, antithetic=antithetic)
+
+        # the feature part of the first r2 layer is computed once per event and broadcast over the samples
+        first = self.r2_layers[0]
+        n_features = event['features'].shape[1]
+        h = first.activation(event['r2_features'] + tf.tensordot(z_samp, first.kernel[n_features:], axes=1))
+        out = apply_layers(self.r2_layers[1:], h)
+        mean_r2, logvar_r2, _ = tf.split(out, num_or_size_splits=[self.x_dim*self.x_modes, self.x_dim*self.x_modes,self.x_modes], axis=-1)
+        scale_r2 = self.EPS + tf.sqrt(tf.exp(logvar_r2))
+
+        tmvn_r2 = tfd.MultivariateNormalDiag(
+            loc=tf.gather(mean_r2,self.masks["nonperiodic_idx_mask"],axis=-1),
+            scale_diag=tf.gather(scale_r2,self.masks["nonperiodic_idx_mask"],axis=-1))
+        vm_loc = 2.0*np.pi*tf.gather(mean_r2,self.masks["periodic_idx_mask"],axis=-1)
+        vm_concentration = tf.math.reciprocal(tf.math.square(2.0*np.pi*tf.gather(scale_r2,self.masks["periodic_idx_mask"],axis=-1)))
+        if von_mises_sampler == 'best_fisher':
+            vm_sample = sample_von_mises(vm_loc, vm_concentration)
+        else:
+            vm_sample = tfp.distributions.VonMises(loc=vm_loc, concentration=vm_concentration).sample()
+        vm_x_sample = tf.math.floormod(vm_sample,(2.0*np.pi))/(2.0*np.pi)
+        return tf.gather(tf.concat([tmvn_r2.sample(),vm_x_sample],axis=-1),self.masks["idx_periodic_mask"],axis=-1)
+
+    def in_bounds_mask(self, x):
+        """Boolean mask over the leading axes of x, true for samples inside the prior cube with mass_1 >= mass_2."""
+        return in_prior_mask(x, self.params['inf_pars'], self.bounds)
+
+    def sample_in_bounds(self, event, n, max_draw=1000, max_tries=100, von_mises_sampler=None):
+        """Draw exactly n valid samples per event by oversampling and refilling, returns (n, n_events, x_dim).
+
+        Each draw is sized from the acceptance rate seen so far and rounded up to a power of
+        two so the sampling graph is only traced for a few shapes, but never exceeds max_draw
+        samples per event so the decoder memory stays bounded by the caller's block size.
+        """
+        n_events = event['features'].shape[0]
+        block = np.empty((n, n_events, self.x_dim), dtype=np.float32)
+        filled = np.zeros(n_events, dtype=int)
+        tries = 0
+        while np.any(filled < n):
+            rate = max(self.n_accepted/self.n_drawn, 0.01) if self.n_drawn > 0 else 1.0
+            n_draw = int(2**np.ceil(np.log2(max(1.2*(n - filled.min())/rate, 1))))
+            draw = self.sample_event_graph(event, min(n_draw, max_draw), von_mises_sampler=von_mises_sampler).numpy()
+            valid = self.in_bounds_mask(draw)
+            self.n_drawn += valid.size
+            self.n_accepted += int(valid.sum())
+            # valid samples first, keeping their draw order
+            order = np.argsort(~valid, axis=0, kind='stable')
+            take = np.minimum(valid.sum(axis=0), n - filled)
+            for e in np.flatnonzero(take):
+                block[filled[e]:filled[e] + take[e], e] = draw[order[:take[e],e],e]
+            filled += take
+            tries = 0 if np.any(take) else tries + 1
+            if tries >= max_tries:
+                raise ValueError('no posterior samples inside the prior bounds after {} draws'.format(self.n_drawn))
+        return block
+
+    def iter_samples(self, y=None, nsamples=1000, block_size=1000, event=None, in_bounds=False, von_mises_sampler=None):
+        """Yield blocks of posterior samples for y until exactly nsamples have been drawn.
+
+        Each block is a (n_block, n_events, x_dim) numpy array with n_block <= block_size,
+        so any number of samples can be drawn in bounded memory at a constant cost per block.
+        With in_bounds only samples passing in_bounds_mask are kept, see sample_in_bounds.
+        """
+        if event is None:
+            event = self.embed_event(y)
+        for start in range(0, nsamples, block_size):
+            if in_bounds:
+                yield self.sample_in_bounds(event, min(block_size, nsamples - start), max_draw=block_size, von_mises_sampler=von_mises_sampler)
             else:
-                #x_sample = tf.concat([x_sample,gm_r2.sample()],axis=0)
-                tmvn_x_sample = tmvn_r2.sample()
-                vm_x_sample = tf.math.floormod(vm_r2.sample(),(2.0*np.pi))/(2.0*np.pi)
-                x_sample = tf.concat([x_sample,tf.gather(tf.concat([tmvn_r2.sample(),vm_x_sample],axis=1),self.masks["idx_periodic_mask"],axis=1)],axis=0)
+                yield self.sample_event_graph(event, min(block_size, nsamples - start), von_mises_sampler=von_mises_sampler).numpy()
 
-        return x_sample
+    def reset_acceptance(self):
+        self.n_drawn = 0
+        self.n_accepted = 0
 
+    def acceptance_rate(self):
+        """Fraction of the samples drawn since reset_acceptance that were inside the prior bounds."""
+        return self.n_accepted/self.n_drawn if self.n_drawn > 0 else 1.0
 
-    def gen_z_samples(self, x, y, nsamples=1000):
-        y = y/self.params['y_normscale']
-        y = tf.tile(y,(nsamples,1,1))
-        x = tf.tile(x,(nsamples,1))
-        mean_r1, logvar_r1, logweight_r1 = self.encode_r1(y=y)
-        scale_r1 = self.EPS + tf.sqrt(tf.exp(logvar_r1))
-        gm_r1 = tfd.MixtureSameFamily(mixture_distribution=tfd.Categorical(logits=logweight_r1),
-                                      components_distribution=tfd.MultivariateNormalDiag(
-                                          loc=mean_r1,
-                                          scale_diag=scale_r1))
-        z_samp_r1 = gm_r1.sample()
-        mean_q, logvar_q = self.encode_q(x=x,y=y)
+    def gen_samples(self, y, ramp=1.0, nsamples=1000, max_samples=1000, event=None, out=None, in_bounds=False, von_mises_sampler=None):
+        """Draw exactly nsamples posterior samples for y, returns (nsamples*n_events, x_dim).
+
+        Samples are drawn in blocks of max_samples and written into out, which can be a
+        preallocated array or an h5py dataset of that shape, otherwise a new array is made.
+        The strain is embedded once, pass event from embed_event to reuse an embedding.
+        With in_bounds every returned sample lies inside the prior cube with mass_1 >= mass_2.
+        von_mises_sampler picks the periodic parameter sampler, see sample_event.
+        """
+        if event is None:
+            event = self.embed_event(y)
+        n_events = event['features'].shape[0]
+        if out is None:
+            out = np.empty((nsamples*n_events, self.x_dim), dtype=np.float32)
+        self.reset_acceptance()
+        row = 0
+        for block in self.iter_samples(nsamples=nsamples, block_size=max_samples, event=event, in_bounds=in_bounds, von_mises_sampler=von_mises_sampler):
+            block = block.reshape(-1, self.x_dim)
+            out[row:row + len(block)] = block
+            row += len(block)
+        if in_bounds:
+            print('... in bounds sampling acceptance rate {:.3f}'.format(self.acceptance_rate()))
+        return out
+
+    def gen_samples_batch(self, y_batch, nsamples=1000, max_rows=50000, out=None, in_bounds=False, von_mises_sampler=None):
+        """Draw nsamples posterior samples for every event in y_batch, returns (n_events, nsamples, x_dim).
+
+        Events are embedded together and sampled in chunks of at most max_rows
+        events x samples, which bounds the memory of the decoder activations.
+        out can be a preallocated array or an h5py dataset of the returned shape.
+        """
+        n_events = y_batch.shape[0]
+        if out is None:
+            out = np.empty((n_events, nsamples, self.x_dim), dtype=np.float32)
+        events_per_chunk = int(min(n_events, max(1, max_rows//nsamples)))
+        samples_per_chunk = int(min(nsamples, max(1, max_rows//events_per_chunk)))
+        self.reset_acceptance()
+        for e_start in range(0, n_events, events_per_chunk):
+            e_stop = min(e_start + events_per_chunk, n_events)
+            event = self.embed_event(y_batch[e_start:e_stop])
+            s_start = 0
+            for block in self.iter_samples(nsamples=nsamples, block_size=samples_per_chunk, event=event, in_bounds=in_bounds, von_mises_sampler=von_mises_sampler):
+                out[e_start:e_stop,s_start:s_start + len(block)] = np.transpose(block, [1,0,2])
+                s_start += len(block)
+        if in_bounds:
+            print('... in bounds sampling acceptance rate {:.3f}'.format(self.acceptance_rate()))
+        return out
+
+    def gen_z_samples(self, x, y, nsamples=1000, event=None):
+        if event is None:
+            event = self.embed_event(y)
+        z_samp_r1 = tf.reshape(self.r1_mixture(event).sample(nsamples), [-1, self.z_dim])
+        mean_q, logvar_q = self.encode_q(x=tf.cast(x, dtype=tf.float32),features=event['features'])
         scale_q = self.EPS + tf.sqrt(tf.exp(logvar_q))
         mvn_q = tfp.distributions.MultivariateNormalDiag(
             loc=mean_q,
             scale_diag=scale_q)
-        z_samp_q = mvn_q.sample()    
-        return mean_r1, z_samp_r1, mean_q, z_samp_q
+        z_samp_q = tf.reshape(mvn_q.sample(nsamples), [-1, self.z_dim])
+        return event['mean_r1'], z_samp_r1, mean_q, z_samp_q
+
+
+def benchmark_latent_sampling(model, y, sample_sizes=(256,1024,4096,16384), repeats=20, quantiles=(0.05,0.5,0.95)):
+    """Compare the spread of posterior quantile estimates for each latent sampling mode.
+
+    The quantiles of every parameter are estimated repeats times for the single event y at
+    each sample size and the rms standard deviation of the estimates is tabulated. The
+    saving is the number of iid samples needed to match a mode's spread divided by the
+    samples that mode used, assuming the 1/sqrt(n) Monte Carlo rate for iid sampling.
+    """
+    modes = [('iid',False), ('iid',True), ('sobol',False), ('sobol',True)]
+    event = model.embed_event(y[:1])
+    spread = {}
+    for latent_sampling, antithetic in modes:
+        for n in sample_sizes:
+            est = np.array([np.quantile(model.sample_event(event, n, latent_sampling=latent_sampling, antithetic=antithetic).numpy()[:,0],
+                                        quantiles, axis=0) for _ in range(repeats)])
+            spread[latent_sampling, antithetic, n] = np.sqrt(np.mean(np.var(est, axis=0)))
+
+    print('{:>8s} {:>11s} {:>8s} {:>12s} {:>8s}'.format('latent','antithetic','samples','quantile std','saving'))
+    for latent_sampling, antithetic in modes:
+        for n in sample_sizes:
+            s = spread[latent_sampling, antithetic, n]
+            print('{:>8s} {:>11s} {:>8d} {:>12.2e} {:>8.2f}'.format(latent_sampling, str(antithetic), n, s, (spread['iid', False, n]/s)**2))
+    return spread
+
+
+def benchmark_trunk_configs(configs, params, bounds, masks, x_dim, n_channels, batch_size=64, nsamples=1000, repeats=5):
+    """Build a CVAE for each named dict of param overrides in configs and tabulate the trunk
+    output size, the number of weights, the float32 checkpoint size, the training step time
+    and the time to draw nsamples posterior samples for one event.
+    """
+    print('{:>20s} {:>10s} {:>12s} {:>10s} {:>10s} {:>12s}'.format('config','features','weights','size (MB)','step (s)','sample (s)'))
+    result = {}
+    for name, overrides in configs.items():
+        config_params = dict(params, **overrides)
+        model = CVAE(x_dim, config_params['ndata'], n_channels, config_params['z_dimension'], config_params['n_modes'], config_params, bounds, masks)
+        optimizer = tf.keras.optimizers.Adam(config_params['initial_training_rate'])
+        x = tf.random.uniform((batch_size, x_dim))
+        y = tf.random.normal((batch_size, model.y_dim, n_channels))
+
+        model.train_step(x, y, optimizer)   # trace
+        start = time.time()
+        for _ in range(repeats):
+            model.train_step(x, y, optimizer)
+        step_time = (time.time() - start)/repeats
+
+        model.gen_samples(y[:1], nsamples=nsamples, max_samples=nsamples)   # trace
+        start = time.time()
+        for _ in range(repeats):
+            model.gen_samples(y[:1], nsamples=nsamples, max_samples=nsamples)
+        sample_time = (time.time() - start)/repeats
+
+        n_weights = int(sum(np.prod(v.shape) for v in model.trainable_variables))
+        result[name] = dict(features=model.trunk.output_shape[-1], weights=n_weights, size=4*n_weights/2**20,
+                            step_time=step_time, sample_time=sample_time)
+        print('{:>20s} {:>10d} {:>12d} {:>10.1f} {:>10.4f} {:>12.4f}'.format(name, result[name]['features'], n_weights,
+                                                                         result[name]['size'], step_time, sample_time))
+    return result
@@ -20,7 +20,8 @@ import plotting
 from tensorflow.keras import regularizers
 
 from vitamin_c_model import CVAE
-from load_data import load_data, load_samples, convert_ra_to_hour_angle, convert_hour_angle_to_ra, DataLoader
+from multirate import multirate
+from load_data import load_data, load_samples, load_all_samples, convert_ra_to_hour_angle, convert_hour_angle_to_ra, DataLoader
 
 def get_param_index(all_pars,pars,sky_extra=None):
     """ 
@@ -134,13 +135,8 @@ def plot_posterior(samples,x_truth,epoch,idx,run='testing',all_other_samples=Non
     """
 
     # trim samples from outside the cube
-    mask = []
-    for s in samples:
-        if (np.all(s>=0.0) and np.all(s<=1.0)):
-            mask.append(True)
-        else:
-            mask.append(False)
-    samples = tf.boolean_mask(samples,mask,axis=0)
+    samples = np.asarray(samples)
+    samples = samples[np.all((samples>=0.0) & (samples<=1.0),axis=1)]
     print('identified {} good samples'.format(samples.shape[0]))
     print(np.array(all_other_samples).shape)
     if samples.shape[0]<100:
@@ -405,12 +401,16 @@ def paper_plots(test_dataset, y_data_test, x_data_test, model, params, plot_dir,
     epoch = 'pub_plot'; ramp = 1
     plotter = plotting.make_plots(params, None, None, x_data_test) 
 
+    # sample all of the test events together
+    start_time_test = time.time()
+    all_samples = model.gen_samples_batch(y_data_test, nsamples=params['n_samples'], in_bounds=params['in_bounds_sampling'])
+    end_time_test = time.time()
+    print('Run {} Testing time elapsed for {} samples of {} events: {}'.format(run,params['n_samples'],len(all_samples),end_time_test - start_time_test))
+
     for step, (x_batch_test, y_batch_test) in test_dataset.enumerate():
-        mu_r1, z_r1, mu_q, z_q = gen_z_samples(model, x_batch_test, y_batch_test, nsamples=1000)
+        mu_r1, z_r1, mu_q, z_q = model.gen_z_samples(x_batch_test, y_batch_test, nsamples=1000)
         plot_latent(mu_r1,z_r1,mu_q,z_q,epoch,step,run=plot_dir)
-        start_time_test = time.time()
-        samples = gen_samples(model, y_batch_test, ramp=ramp, nsamples=params['n_samples'])
-        end_time_test = time.time()
+        samples = all_samples[step]
         if np.any(np.isnan(samples)):
             print('Found nans in samples. Not making plots')
             for k,s in enumerate(samples):
@@ -418,7 +418,6 @@ def paper_plots(test_dataset, y_data_test, x_data_test, model, params, plot_dir,
                     print(k,s)
             KL_est = [-1,-1,-1]
         else:
-            print('Run {} Testing time elapsed for {} samples: {}'.format(run,params['n_samples'],end_time_test - start_time_test))
             KL_est = plot_posterior(samples,x_batch_test[0,:],epoch,step,all_other_samples=bilby_samples[:,step,:],run=plot_dir)
             _ = plot_posterior(samples,x_batch_test[0,:],epoch,step,run=plot_dir)
     print('... Finished making publication plots! Congrats fam.')
@@ -481,12 +480,10 @@ def run_vitc_old(params, x_data_train, y_data_train, x_data_val, y_data_val, x_d
 
     x_data_test, y_data_test_noisefree, y_data_test, snrs_test = load_data(params,bounds,fixed_vals,params['test_set_dir'],params['inf_pars'],test_data=True)
     y_data_test = y_data_test[:params['r'],:,:]; x_data_test = x_data_test[:params['r'],:]
+    y_data_test = multirate(y_data_test, params['multirate_bands'])
 
     # load precomputed samples
-    bilby_samples = []
-    for sampler in params['samplers'][1:]:
-        bilby_samples.append(load_samples(params,sampler, bounds = bounds))
-    bilby_samples = np.array(bilby_samples)
+    bilby_samples = load_all_samples(params, bounds = bounds)
     #bilby_samples = np.array([load_samples(params,'dynesty'),load_samples(params,'ptemcee'),load_samples(params,'cpnest')])
 
     if not make_paper_plots:
@@ -602,7 +599,7 @@ def run_vitc_old(params, x_data_train, y_data_train, x_data_val, y_data_val, x_d
                 mu_r1, z_r1, mu_q, z_q = model.gen_z_samples(x_batch_test, y_batch_test, nsamples=1000)
                 plot_latent(mu_r1,z_r1,mu_q,z_q,epoch,step,run=plot_dir)
                 start_time_test = time.time()
-                samples = model.gen_samples(y_batch_test, ramp=ramp, nsamples=params['n_samples'])
+                samples = model.gen_samples(y_batch_test, ramp=ramp, nsamples=params['n_samples'], in_bounds=params['in_bounds_sampling'])
                 end_time_test = time.time()
                 if np.any(np.isnan(samples)):
                     print('Epoch: {}, found nans in samples. Not making plots'.format(epoch))
@@ -687,17 +684,15 @@ def run_vitc(params, x_data_train, y_data_train, x_data_val, y_data_val, x_data_
 
     # load the training data
     if not make_paper_plots:
-        train_dataset = DataLoader(params["train_set_dir"],params = params,bounds = bounds, masks = masks,fixed_vals = fixed_vals, chunk_batch = 40) 
-        validation_dataset = DataLoader(params["val_set_dir"],params = params,bounds = bounds, masks = masks,fixed_vals = fixed_vals, chunk_batch = 2)
+        train_dataset = DataLoader(params["train_set_dir"],params = params,bounds = bounds, masks = masks,fixed_vals = fixed_vals, chunk_batch = 40, prefetch = params["prefetch_chunks"], shuffle = params["shuffle_training_data"], shuffle_block_size = params["shuffle_block_size"], num_workers = params["loader_workers"], stall_tolerance = params["loader_stall_tolerance"], raw_cache_bytes = int(params["raw_chunk_cache_gb"]*1e9), use_manifest = params["use_data_manifest"], freq_domain = params["freq_domain_cache"], batch_augment = params["per_batch_augmentation"], extrinsic = params["extrinsic_augmentation"]) 
+        validation_dataset = DataLoader(params["val_set_dir"],params = params,bounds = bounds, masks = masks,fixed_vals = fixed_vals, chunk_batch = 2, use_manifest = params["use_data_manifest"])
 
     x_data_test, y_data_test_noisefree, y_data_test, snrs_test = load_data(params,bounds,fixed_vals,params['test_set_dir'],params['inf_pars'],test_data=True)
     y_data_test = y_data_test[:params['r'],:,:]; x_data_test = x_data_test[:params['r'],:]
+    y_data_test = multirate(y_data_test, params['multirate_bands'])
 
     # load precomputed samples
-    bilby_samples = []
-    for sampler in params['samplers'][1:]:
-        bilby_samples.append(load_samples(params,sampler, bounds = bounds))
-    bilby_samples = np.array(bilby_samples)
+    bilby_samples = load_all_samples(params, bounds = bounds)
     #bilby_samples = np.array([load_samples(params,'dynesty'),load_samples(params,'ptemcee'),load_samples(params,'cpnest')])
 
     test_dataset = (tf.data.Dataset.from_tensor_slices((x_data_test,y_data_test))
@@ -752,11 +747,21 @@ def run_vitc(params, x_data_train, y_data_train, x_data_val, y_data_val, x_data_
     shutil.copy('./params_files/params.json',path)
 
     print("Loading intitial data....")
-    train_dataset.load_next_chunk()
+    if params["tf_data_pipeline"]:
+        # stream the training data, len(train_dataset) batches are taken from the pipeline each epoch
+        train_iterator = iter(train_dataset.get_tf_dataset().repeat())
+    else:
+        train_dataset.load_next_chunk()
     validation_dataset.load_next_chunk()
     
     model.compile()
 
+    @tf.function
+    def augmented_train_step(x, y, ramp):
+        # the batch augmentation is traced into the same graph as the training step
+        y, x = train_dataset.augment_batch(y, x)
+        return model.train_step(x, y, optimizer, ramp=ramp)
+
     for epoch in range(1, epochs + 1):
 
         train_loss_kl_q = 0.0
@@ -769,11 +774,17 @@ def run_vitc(params, x_data_train, y_data_train, x_data_val, y_data_val, x_data_
             ramp = tf.convert_to_tensor(ramp_func(epoch,ramp_start,ramp_length,ramp_cycles), dtype=tf.float32)
 
         for step in range(len(train_dataset)):
-            y_batch_train, x_batch_train = train_dataset[step]
+            if params["tf_data_pipeline"]:
+                y_batch_train, x_batch_train = next(train_iterator)
+            else:
+                y_batch_train, x_batch_train = train_dataset[step]
             if len(y_batch_train) == 0:
                 print("NO data: ", train_dataset.chunk_iter, np.shape(y_batch_train))
             #print(step, np.shape(y_batch_train),np.shape(x_batch_train))
-            temp_train_r_loss, temp_train_kl_loss = model.train_step(x_batch_train, y_batch_train, optimizer, ramp=ramp)
+            if train_dataset.batch_augment and not params["tf_data_pipeline"]:
+                temp_train_r_loss, temp_train_kl_loss = augmented_train_step(x_batch_train, y_batch_train, ramp)
+            else:
+                temp_train_r_loss, temp_train_kl_loss = model.train_step(x_batch_train, y_batch_train, optimizer, ramp=ramp)
             train_loss[epoch-1,0] += temp_train_r_loss
             train_loss[epoch-1,1] += temp_train_kl_loss
         train_loss[epoch-1,2] = train_loss[epoch-1,0] + ramp*train_loss[epoch-1,1]
@@ -810,12 +821,15 @@ def run_vitc(params, x_data_train, y_data_train, x_data_val, y_data_val, x_data_
 
         # generate and plot posterior samples for the latent space and the parameter space 
         if epoch % plot_cadence == 0:
+            # sample all of the test events together
+            start_time_test = time.time()
+            all_samples = model.gen_samples_batch(y_data_test, nsamples=params['n_samples'], in_bounds=params['in_bounds_sampling'])
+            end_time_test = time.time()
+            print('Epoch: {}, run {} Testing time elapsed for {} samples of {} events: {}'.format(epoch,run,params['n_samples'],len(all_samples),end_time_test - start_time_test))
             for step, (x_batch_test, y_batch_test) in test_dataset.enumerate():             
                 mu_r1, z_r1, mu_q, z_q = model.gen_z_samples(x_batch_test, y_batch_test, nsamples=1000)
                 plot_latent(mu_r1,z_r1,mu_q,z_q,epoch,step,run=plot_dir)
-                start_time_test = time.time()
-                samples = model.gen_samples(y_batch_test, ramp=ramp, nsamples=params['n_samples'])
-                end_time_test = time.time()
+                samples = all_samples[step]
                 if np.any(np.isnan(samples)):
                     print('Epoch: {}, found nans in samples. Not making plots'.format(epoch))
                     for k,s in enumerate(samples):
@@ -823,7 +837,6 @@ def run_vitc(params, x_data_train, y_data_train, x_data_val, y_data_val, x_data_
                             print(k,s)
                     KL_est = [-1,-1,-1]
                 else:
-                    print('Epoch: {}, run {} Testing time elapsed for {} samples: {}'.format(epoch,run,params['n_samples'],end_time_test - start_time_test))
                     KL_est = plot_posterior(samples,x_batch_test[0,:],epoch,step,all_other_samples=bilby_samples[:,step,:],run=plot_dir)
                     _ = plot_posterior(samples,x_batch_test[0,:],epoch,step,run=plot_dir)
                 KL_samples.append(KL_est)
@@ -832,9 +845,15 @@ def run_vitc(params, x_data_train, y_data_train, x_data_val, y_data_val, x_data_
             #plot_KL(np.reshape(np.array(KL_samples),[-1,params['r'],len(params['samplers'])]),plot_cadence,run=plot_dir)
 
         # iterate the chunk, i.e. load more noisefree data in
-        if epoch % 10 == 0:
+        if epoch % 10 == 0 and not params["tf_data_pipeline"]:
             print("Loading the next Chunk ...")
             train_dataset.load_next_chunk()
+        elif params["echo_augmentation"] and not params["tf_data_pipeline"]:
+            # fresh noise and randomisation on the cached raw chunk
+            train_dataset.refresh_chunk()
+
+    # stop any background chunk loading
+    train_dataset.close()
 
 
 